@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Running jobs in sites from asyncio code.
+
+Jobs are run by the :class:`~.ISiteTransactionRunner` utility on a
+dedicated pool of threads, no larger than the pool of connections of
+the database, so that waiting jobs queue up in the event loop instead
+of waiting for a connection.
+
+.. versionadded:: 3.2.0
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import asyncio
+import contextvars
+import threading
+import time
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+
+from zope import component
+from zope.component.hooks import setSite
+
+from ZODB.interfaces import IDatabase
+
+from nti.site.interfaces import ISiteTransactionRunner
+
+from nti.site.runner import _carried_site_names
+from nti.site.runner import get_possible_site_names
+
+__all__ = [
+    'AsyncSiteJobRunner',
+    'AsyncSiteJobRunnerStats',
+    'run_job_in_site_async',
+]
+
+
+class AsyncSiteJobRunnerStats(object):
+    """
+    Counters describing the work of an :class:`AsyncSiteJobRunner`.
+    """
+
+    def __init__(self):
+        #: The number of jobs waiting for a thread.
+        self.waiting = 0
+        #: The number of jobs running.
+        self.running = 0
+        #: The number of jobs that have finished, successfully or not.
+        self.completed = 0
+        #: The total and maximum time, in seconds, that jobs waited for a thread.
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def mean_wait_time(self):
+        started = self.running + self.completed
+        return self.total_wait_time / started if started else 0.0
+
+    def __repr__(self):
+        return "<%s waiting=%d running=%d completed=%d mean_wait_time=%.3f>" % (
+            type(self).__name__,
+            self.waiting, self.running, self.completed, self.mean_wait_time
+        )
+
+
+class AsyncSiteJobRunner(object):
+    """
+    Runs jobs in a transaction and site, in threads, for asyncio code.
+
+    Instances are called like :func:`~nti.site.runner.run_job_in_site`
+    but return an awaitable. No more than *max_workers* jobs run at once;
+    the rest wait (in the event loop) in the order they were submitted.
+    The current site names (see
+    :func:`~nti.site.runner.get_possible_site_names`) and the
+    :mod:`contextvars` context are captured when a job is submitted
+    and used when it runs.
+
+    An instance may be used with any number of event loops, one
+    after the other (for example, with repeated calls to
+    :func:`asyncio.run`) or at the same time in different threads.
+    Each loop queues its own jobs, but they all share the threads.
+    The :attr:`stats` are only exact if one loop is used at a time.
+    """
+
+    def __init__(self, max_workers=None, runner=None):
+        """
+        :keyword int max_workers: The number of threads. Defaults to the
+            size of the connection pool of the :class:`~ZODB.interfaces.IDatabase`
+            utility.
+        :keyword runner: The :class:`~.ISiteTransactionRunner` to use.
+            Defaults to looking up the utility when each job is submitted.
+        """
+        if max_workers is None:
+            max_workers = component.getUtility(IDatabase).getPoolSize()
+        self.max_workers = max_workers
+        self.runner = runner
+        self.stats = AsyncSiteJobRunnerStats()
+        self._executor = ThreadPoolExecutor(max_workers,
+                                            thread_name_prefix='nti.site.asyncrunner')
+        # {loop: Semaphore}. Semaphores can only be used with one loop.
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._semaphores_lock = threading.Lock()
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self._semaphores_lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_workers)
+        return semaphore
+
+    async def __call__(self, func, **kwargs):
+        """
+        Run *func* as the :class:`~.ISiteTransactionRunner` would, with the
+        same keyword arguments, and return its result.
+        """
+        runner = self.runner or component.getUtility(ISiteTransactionRunner)
+        site_names = get_possible_site_names()
+        context = contextvars.copy_context()
+        stats = self.stats
+
+        def run():
+            # The context may carry the caller's site (see
+            # nti.site.contextsite), whose objects belong to the
+            # caller's connection. Start with none, like a new thread.
+            setSite(None)
+            _carried_site_names.set(site_names)
+            return runner(func, **kwargs)
+
+        semaphore = self._get_semaphore()
+        submitted = time.monotonic()
+        stats.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            stats.waiting -= 1
+
+        try:
+            wait_time = time.monotonic() - submitted
+            stats.total_wait_time += wait_time
+            stats.max_wait_time = max(stats.max_wait_time, wait_time)
+            stats.running += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor,
+                    context.run,
+                    run)
+            finally:
+                stats.running -= 1
+                stats.completed += 1
+        finally:
+            semaphore.release()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads.
+        """
+        self._executor.shutdown(wait=wait)
+
+
+_default_runner = None
+
+async def run_job_in_site_async(func, **kwargs):
+    """
+    Run *func* using a shared :class:`AsyncSiteJobRunner`, created
+    with the default arguments the first time this is called.
+    """
+    global _default_runner # pylint:disable=global-statement
+    if _default_runner is None:
+        _default_runner = AsyncSiteJobRunner()
+    return await _default_runner(func, **kwargs)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checkpoints for resuming jobs run across all host sites.
+
+See :func:`nti.site.hostpolicy.run_job_in_all_host_sites`.
+
+.. versionadded:: 3.2.0
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import io
+import os
+
+import transaction
+
+from BTrees import family64
+
+from zope import component
+from zope import interface
+
+from zope.traversing.interfaces import IEtcNamespace
+
+from nti.site.interfaces import IHostSiteJobCheckpoint
+
+
+@interface.implementer(IHostSiteJobCheckpoint)
+class PersistentHostSiteJobCheckpoint(object):
+    """
+    Records completed site names in the database, under *job_key*, in
+    the host sites folder (see :class:`~.HostSitesFolder`).
+
+    Because the record is made in the same transaction as the job
+    itself, it is exactly as durable as the work done by the job.
+    """
+
+    def __init__(self, job_key):
+        self.job_key = job_key
+
+    @staticmethod
+    def _sites_folder():
+        return component.getUtility(IEtcNamespace, name='hostsites')
+
+    def _completed(self, create=False):
+        sites = self._sites_folder()
+        checkpoints = sites.jobCheckpoints
+        if checkpoints is None:
+            if not create:
+                return None
+            checkpoints = sites.jobCheckpoints = family64.OO.BTree()
+        completed = checkpoints.get(self.job_key)
+        if completed is None and create:
+            completed = checkpoints[self.job_key] = family64.OO.TreeSet()
+        return completed
+
+    def is_completed(self, site_name):
+        completed = self._completed()
+        return completed is not None and site_name in completed
+
+    def mark_completed(self, site_name):
+        self._completed(create=True).add(site_name)
+
+    def clear(self):
+        checkpoints = self._sites_folder().jobCheckpoints
+        if checkpoints is not None and self.job_key in checkpoints:
+            del checkpoints[self.job_key]
+
+
+@interface.implementer(IHostSiteJobCheckpoint)
+class FileHostSiteJobCheckpoint(object):
+    """
+    Records completed site names in a local text file at *path*, one
+    per line.
+
+    Names are only appended to the file after the transaction that
+    marked them completed commits successfully.
+    """
+
+    def __init__(self, path, transaction_manager=None):
+        """
+        :keyword transaction_manager: The transaction manager whose
+            transactions the job runs in. Defaults to the thread-local
+            transaction manager.
+        """
+        self.path = path
+        self.transaction_manager = transaction_manager or transaction.manager
+        self._completed = set()
+        self._pending_tx = None
+        self._pending = None
+        # Incremented by clear(), so that names marked before
+        # then aren't written after.
+        self._generation = 0
+        if os.path.exists(path):
+            with io.open(path, 'r', encoding='utf-8') as f:
+                self._completed.update(line.strip() for line in f if line.strip())
+
+    def is_completed(self, site_name):
+        return site_name in self._completed
+
+    def mark_completed(self, site_name):
+        tx = self.transaction_manager.get()
+        if tx is not self._pending_tx:
+            self._pending_tx = tx
+            self._pending = []
+            tx.addAfterCommitHook(self._write_pending, (self._pending, self._generation))
+        self._pending.append(site_name)
+
+    def _write_pending(self, status, names, generation):
+        if not status or generation != self._generation:
+            return
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            for name in names:
+                f.write(name + '\n')
+        self._completed.update(names)
+
+    def clear(self):
+        self._completed.clear()
+        self._pending_tx = self._pending = None
+        self._generation += 1
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Optional storage of the current site in a :mod:`contextvars`
+variable instead of a thread-local.
+
+By default, :mod:`zope.component.hooks` keeps the current site (and
+its site manager) in a :class:`threading.local`, so every task
+running in a thread shares a single current site. That's fine for one
+request per thread, but not for many concurrent asyncio tasks (or
+greenlets, in versions of gevent that give each greenlet its own
+context) in one thread.
+
+Calling :func:`install_context_site_storage` replaces that storage
+with a :class:`ContextSiteInfo`. After that, everything that uses
+:func:`zope.component.hooks.setSite` and
+:func:`zope.component.hooks.getSite` (which includes
+:func:`nti.site.subscribers.threadSiteSubscriber`, the
+:mod:`nti.site.runner` and the helpers in :mod:`nti.site.testing`)
+sees a current site specific to the running context. New threads,
+like new contexts, start with no site. Each asyncio task runs in a
+copy of the context of the code that created it, so it starts with
+that site, but setting a site in the task doesn't affect its creator.
+Work handed to a thread pool (for example, with
+:meth:`asyncio.loop.run_in_executor`) runs with no site unless it is
+run in a copy of the context with :func:`contextvars.copy_context`.
+
+This should be done once, early in process startup, before any site
+is set.
+
+.. versionadded:: 3.2.0
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+from contextvars import ContextVar
+
+from zope.component import hooks
+from zope.component.globalregistry import getGlobalSiteManager
+
+__all__ = [
+    'ContextSiteInfo',
+    'install_context_site_storage',
+    'uninstall_context_site_storage',
+    'is_context_site_storage_installed',
+]
+
+
+class ContextSiteInfo(object):
+    """
+    A replacement for :data:`zope.component.hooks.siteinfo` that keeps
+    the site, the site manager and the adapter hook in a
+    :class:`contextvars.ContextVar`.
+
+    The three values are stored together as a tuple that is replaced
+    (never mutated) when one of them changes, so setting the site in
+    one context can't be seen in any other.
+    """
+
+    def __init__(self, name='nti.site.current_site'):
+        # (site, site manager, adapter hook or None)
+        self._state = ContextVar(name, default=(None, getGlobalSiteManager(), None))
+
+    @property
+    def site(self):
+        return self._state.get()[0]
+
+    @site.setter
+    def site(self, site):
+        _, sm, hook = self._state.get()
+        self._state.set((site, sm, hook))
+
+    @property
+    def sm(self):
+        return self._state.get()[1]
+
+    @sm.setter
+    def sm(self, sm):
+        site, _, hook = self._state.get()
+        self._state.set((site, sm, hook))
+
+    @property
+    def adapter_hook(self):
+        site, sm, hook = self._state.get()
+        if hook is None:
+            hook = sm.adapters.adapter_hook
+            self._state.set((site, sm, hook))
+        return hook
+
+    @adapter_hook.deleter
+    def adapter_hook(self):
+        site, sm, hook = self._state.get()
+        if hook is None:
+            raise AttributeError('adapter_hook')
+        self._state.set((site, sm, None))
+
+
+_thread_siteinfo = None
+
+def install_context_site_storage():
+    """
+    Make :mod:`zope.component.hooks` store the current site in a
+    :class:`ContextSiteInfo`.
+
+    The current site of the calling thread becomes the current site
+    of the calling context. Calling this when context storage is
+    already installed does nothing.
+
+    :return: The installed :class:`ContextSiteInfo`.
+    """
+    global _thread_siteinfo # pylint:disable=global-statement
+    if isinstance(hooks.siteinfo, ContextSiteInfo):
+        return hooks.siteinfo
+
+    thread_siteinfo = hooks.siteinfo
+    context_siteinfo = ContextSiteInfo()
+    context_siteinfo.site = thread_siteinfo.site
+    context_siteinfo.sm = thread_siteinfo.sm
+    _thread_siteinfo = thread_siteinfo
+    hooks.siteinfo = context_siteinfo
+    logger.debug("Storing the current site in a context variable")
+    return context_siteinfo
+
+
+def uninstall_context_site_storage():
+    """
+    Undo :func:`install_context_site_storage`, restoring the
+    thread-local storage. The current site of the calling context
+    becomes the current site of the calling thread.
+    """
+    global _thread_siteinfo # pylint:disable=global-statement
+    context_siteinfo = hooks.siteinfo
+    if not isinstance(context_siteinfo, ContextSiteInfo):
+        return
+
+    thread_siteinfo = _thread_siteinfo
+    _thread_siteinfo = None
+    hooks.siteinfo = thread_siteinfo
+    hooks.setSite(context_siteinfo.site)
+
+
+def is_context_site_storage_installed():
+    """
+    Is the current site stored in a :class:`ContextSiteInfo`?
+    """
+    return isinstance(hooks.siteinfo, ContextSiteInfo)
@@ -9,6 +9,9 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
+from BTrees import family64
+from BTrees.Length import Length
+
 from zope import interface
 
 from zope.site.folder import Folder
@@ -28,6 +31,129 @@ class HostSitesFolder(Folder):
     """
     lastSynchronized = 0
 
+    #: A BTree mapping job keys to the set of site names completed by
+    #: that job, used by :class:`nti.site.checkpoint.PersistentHostSiteJobCheckpoint`.
+    #: Created on demand.
+    jobCheckpoints = None
+
+    #: A BTree mapping the name of each host site to the set of names of
+    #: the host sites that directly descend from it. Sites that descend
+    #: from the main application site are stored under the empty string.
+    #: Maintained by :func:`nti.site.hostpolicy.synchronize_host_policies` and
+    #: by removing sites from this folder. ``None`` until first built, which
+    #: ``synchronize_host_policies`` does for databases created before it existed.
+    childrenIndex = None
+
+    #: A BTree mapping the name of each host site to the name of its parent
+    #: host site (or the empty string). The inverse of :attr:`childrenIndex`.
+    parentIndex = None
+
+    #: Whether persistent sites are created on demand. See
+    #: :func:`nti.site.hostpolicy.synchronize_host_policies`.
+    lazyHostSites = False
+
+    #: A :class:`BTrees.Length.Length` counting the sites created on demand.
+    #: Created on demand; use :attr:`materializedSiteCount`.
+    materializedSites = None
+
+    @property
+    def materializedSiteCount(self):
+        """
+        The number of host sites that have been created on demand
+        by :func:`nti.site.hostpolicy.materialize_host_site`.
+        """
+        return self.materializedSites() if self.materializedSites is not None else 0
+
+    def noteHostSitesMaterialized(self, count=1):
+        # Length resolves conflicts between concurrent increments.
+        if self.materializedSites is None:
+            self.materializedSites = Length()
+        self.materializedSites.change(count)
+
+    def indexHostSite(self, name, parent_name=''):
+        """
+        Record that the host site *name* directly descends from the host
+        site *parent_name*.
+        """
+        if self.childrenIndex is None:
+            self.childrenIndex = family64.OO.BTree()
+            self.parentIndex = family64.OO.BTree()
+        parent_name = parent_name or ''
+        old_parent = self.parentIndex.get(name)
+        if old_parent == parent_name:
+            return
+        if old_parent is not None:
+            self.childrenIndex[old_parent].discard(name)
+        self.parentIndex[name] = parent_name
+        children = self.childrenIndex.get(parent_name)
+        if children is None:
+            children = self.childrenIndex[parent_name] = family64.OO.TreeSet()
+        children.add(name)
+
+    def unindexHostSite(self, name):
+        """
+        Forget the host site *name*.
+
+        Any children it had are indexed as children of its parent
+        instead, so they can still be reached by walking the index
+        from the top. (If the site is created again,
+        :func:`~.synchronize_host_policies` puts them back.)
+        """
+        if self.parentIndex is None or name not in self.parentIndex:
+            return
+        parent_name = self.parentIndex.pop(name)
+        self.childrenIndex[parent_name].discard(name)
+        orphans = self.childrenIndex.pop(name, ())
+        for child_name in orphans:
+            self.parentIndex[child_name] = parent_name
+            self.childrenIndex[parent_name].add(child_name)
+
+    def getChildSiteNames(self, parent_name=''):
+        """
+        Return the sorted names of the host sites directly descending from
+        the host site *parent_name*, or from the main application site
+        if no name is given.
+
+        If the index hasn't been built yet, this is computed (slowly) from
+        the contained sites, without building it.
+        """
+        parent_name = parent_name or ''
+        if self.childrenIndex is None:
+            return tuple(sorted(name for name, parent in self._iterParentNames()
+                                if parent == parent_name))
+        return tuple(self.childrenIndex.get(parent_name, ()))
+
+    def _iterParentNames(self):
+        # Pairs of (name, parent name) found from the bases of the
+        # site manager of each contained site.
+        for name, site in self.items():
+            parent_name = ''
+            for base in site.getSiteManager().__bases__:
+                parent = getattr(base, '__parent__', None)
+                # pylint:disable-next=no-value-for-parameter
+                if IHostPolicyFolder.providedBy(parent) and parent.__parent__ is self:
+                    parent_name = parent.__name__
+                    break
+            yield name, parent_name
+
+    def rebuildChildrenIndex(self):
+        """
+        Compute :attr:`childrenIndex` from the bases of the site manager
+        of each contained site. :func:`~.synchronize_host_policies` does
+        this for databases created before the index existed.
+        """
+        logger.info("Building the host site children index for %r", self)
+        self.childrenIndex = self.parentIndex = None
+        for name, parent_name in list(self._iterParentNames()):
+            self.indexHostSite(name, parent_name)
+        if self.childrenIndex is None:
+            self.childrenIndex = family64.OO.BTree()
+            self.parentIndex = family64.OO.BTree()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.unindexHostSite(key)
+
     def __repr__(self):
         try:
             return super().__repr__()
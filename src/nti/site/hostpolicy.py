@@ -13,6 +13,11 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
+import time
+
+from collections import deque
+from contextlib import ExitStack
+
 from six import string_types
 
 from zope import lifecycleevent
@@ -35,12 +40,14 @@ from zope.site.folder import rootFolder
 from .folder import HostPolicyFolder
 from .folder import HostPolicySiteManager
 from .folder import HostSitesFolder
+from .interfaces import IHostPolicyFolder
 from .interfaces import IMainApplicationFolder
 from .site import BTreeLocalSiteManager
+from .site import coalesced_registry_changes
 
 text_type = str
 
-def synchronize_host_policies():
+def synchronize_host_policies(lazy=None):
     """
     Called within a transaction with a site being the current application
     site, find any :mod:`z3c.baseregistry` components that
@@ -48,6 +55,21 @@ def synchronize_host_policies():
 
     As a prerequisite, :func:`install_sites_folder` must have been done, and
     we must be in that site.
+
+    :keyword bool lazy: If given, sets whether the host sites folder uses
+        lazy mode (see :attr:`.HostSitesFolder.lazyHostSites`), which is
+        stored persistently. If None (the default), the stored setting is used.
+        In lazy mode, no sites are created here. Instead, a site and its
+        missing ancestors are created the first time a job that can
+        write, run with :func:`nti.site.runner.run_job_in_site`, resolves
+        it. Until a persistent site is created, :func:`~.get_site_for_site_names`
+        resolves it to a non-persistent site, just as it does for sites
+        that have never been synchronized; lookups alone never write.
+        Sites can also be created explicitly with
+        :func:`provision_host_sites` or :func:`materialize_host_site`.
+
+    .. versionchanged:: 3.2.0
+       Add the *lazy* argument.
     """
 
     # TODO: We will ultimately need to deal with removing and renaming
@@ -82,6 +104,16 @@ def synchronize_host_policies():
     ds_folder = sites.__parent__
     assert IMainApplicationFolder.providedBy(ds_folder)
 
+    if sites.childrenIndex is None:
+        # Databases created before the index existed.
+        sites.rebuildChildrenIndex()
+
+    if lazy is not None:
+        sites.lazyHostSites = bool(lazy)
+    if sites.lazyHostSites:
+        logger.info("Host sites folder %r is lazy; not creating sites", sites)
+        return
+
     ds_site_manager = ds_folder.getSiteManager()
 
     # Ok, find everything that is globally registered
@@ -102,34 +134,248 @@ def synchronize_host_policies():
     # base, otherwise it gets the previous one we put in.
 
     for site_ro in site_ros:
-        site_ro = reversed(site_ro)
-
-        secondary_comps = ds_site_manager
-        for comps in site_ro:
-            name = comps.__name__
-            logger.debug("Checking host policy for site %s", name)
-            if name.endswith('base') or name.startswith('base'):
-                # The GSM or the base global objects
-                # TODO: better way to do this...marker interface?
-                continue # pragma: no cover
-            if name in sites:
-                logger.debug("Host policy for %s already in place", name)
-                # Ok, we've already put one in for this level.
-                # We need to make it our next choice going forward
-                secondary_comps = sites[name].getSiteManager()
-            else:
-                # Great, create the site
-                logger.info("Installing site policy %s", name)
-
-                site = HostPolicyFolder()
-                # should fire object created event
-                sites[name] = site
-
-                site_policy = HostPolicySiteManager(site)
-                site_policy.__bases__ = (comps, secondary_comps)
-                # should fire INewLocalSite
-                site.setSiteManager(site_policy)
-                secondary_comps = site_policy
+        _install_host_site_ro(sites, ds_site_manager, site_ro)
+
+
+def _install_host_site_ro(sites, ds_site_manager, site_ro):
+    # Create any missing persistent sites in *site_ro*, walking from the top
+    # of the resolution order (the end of the list) towards the root.
+    # Return how many were created.
+    created = 0
+    secondary_comps = ds_site_manager
+    for comps in reversed(site_ro):
+        name = comps.__name__
+        logger.debug("Checking host policy for site %s", name)
+        if name.endswith('base') or name.startswith('base'):
+            # The GSM or the base global objects
+            # TODO: better way to do this...marker interface?
+            continue # pragma: no cover
+        # Keep the index of parents to children up to date,
+        # including for sites created before it existed.
+        sites.indexHostSite(name, _host_site_name(secondary_comps))
+        if name in sites:
+            logger.debug("Host policy for %s already in place", name)
+            # Ok, we've already put one in for this level.
+            # We need to make it our next choice going forward
+            secondary_comps = sites[name].getSiteManager()
+        else:
+            # Great, create the site
+            logger.info("Installing site policy %s", name)
+
+            site = HostPolicyFolder()
+            # should fire object created event
+            sites[name] = site
+
+            site_policy = HostPolicySiteManager(site)
+            site_policy.__bases__ = (comps, secondary_comps)
+            # should fire INewLocalSite
+            site.setSiteManager(site_policy)
+            secondary_comps = site_policy
+            created += 1
+    return created
+
+
+def materialize_host_site(site_components, sites=None):
+    """
+    Find or create the persistent site for the global *site_components*.
+
+    Any missing persistent sites for the ancestors of *site_components*
+    are created first, exactly as :func:`synchronize_host_policies` would.
+    This is used to create sites on demand when the host sites folder is
+    in lazy mode, as :func:`nti.site.runner.run_job_in_site` does when
+    a job that isn't side-effect free resolves a site that hasn't been
+    created yet; the number of sites created this way is tracked by
+    :attr:`.HostSitesFolder.materializedSiteCount`. Looking up a site
+    with :func:`~.get_site_for_site_names` alone never creates it.
+
+    Creation is safe in the face of concurrency: if two transactions
+    create the same site, the later one gets a
+    :class:`~ZODB.POSException.ConflictError` when committing, and, on retry,
+    finds the site already in place.
+
+    .. caution:: If the transaction is aborted (for example, because it
+       was run as side-effect free), so are the created sites.
+
+    :keyword sites: The host sites folder. If not given, it is looked up
+       from the current site.
+    :return: The persistent :class:`~.HostPolicyFolder`.
+
+    .. versionadded:: 3.2.0
+    """
+    if sites is None:
+        sites = component.getUtility(IEtcNamespace, name='hostsites')
+    ds_site_manager = sites.__parent__.getSiteManager()
+    created = _install_host_site_ro(sites, ds_site_manager, ro.ro(site_components))
+    if created:
+        sites.noteHostSitesMaterialized(created)
+    return sites[site_components.__name__]
+
+
+class HostSiteProvisioningResult(object):
+    """
+    The outcome of :func:`provision_host_sites`.
+    """
+
+    def __init__(self, created, batches, elapsed):
+        #: The number of persistent sites created.
+        self.created = created
+        #: The number of batches (and hence commits) used.
+        self.batches = batches
+        #: The total time taken, in seconds.
+        self.elapsed = elapsed
+
+    @property
+    def sites_per_second(self):
+        return self.created / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return "<%s created=%d batches=%d elapsed=%.3f sites_per_second=%.1f>" % (
+            type(self).__name__,
+            self.created, self.batches, self.elapsed, self.sites_per_second
+        )
+
+
+def _missing_host_site_components(sites, site_names=None):
+    # The global components named in *site_names* (or all of them), and
+    # their ancestors, that don't have persistent sites yet, ordered so
+    # that parents come before their children.
+    global_sm = component.getGlobalSiteManager()
+    if site_names is None:
+        all_components = [comps for _, comps in global_sm.getUtilitiesFor(IComponents)]
+    else:
+        all_components = [global_sm.getUtility(IComponents, name=name) for name in site_names]
+
+    ordered = []
+    seen = set()
+    for comps in all_components:
+        for ancestor in reversed(ro.ro(comps)):
+            name = ancestor.__name__
+            if name.endswith('base') or name.startswith('base') or name in seen:
+                continue
+            seen.add(name)
+            if name not in sites:
+                ordered.append(ancestor)
+    return ordered
+
+
+def provision_host_sites(batch_size=100, site_names=None):
+    """
+    Like :func:`synchronize_host_policies`, but creates the missing
+    persistent sites in bounded batches, committing the transaction
+    after each batch.
+
+    This is intended for registering thousands of new sites at once, where
+    a single enormous commit would take too long and conflict with other
+    traffic. Sites are created parents first, so every batch only refers
+    to sites that are already committed or in the same batch.
+
+    As with :func:`synchronize_host_policies`, this must be called with the
+    main application site current and a transaction begun. Each commit is done
+    with the transaction manager of the connection holding the sites; if
+    it is in explicit mode, a new transaction is begun afterwards. The
+    caller is responsible for the final transaction.
+
+    :keyword int batch_size: The maximum number of sites created per commit.
+    :keyword site_names: If given, only the sites with these names (and their
+        ancestors) are created. Otherwise, sites are created for all
+        globally registered components.
+    :rtype: HostSiteProvisioningResult
+
+    .. versionadded:: 3.2.0
+    """
+    begin = time.time()
+    sites = component.getUtility(IEtcNamespace, name='hostsites')
+    ds_site_manager = sites.__parent__.getSiteManager()
+    conn = getattr(sites, '_p_jar', None)
+
+    ordered = _missing_host_site_components(sites, site_names)
+
+    created = batches = 0
+    for i in range(0, len(ordered), batch_size):
+        batch = ordered[i:i + batch_size]
+        for comps in batch:
+            created += _install_host_site_ro(sites, ds_site_manager, ro.ro(comps))
+        batches += 1
+        if conn is not None:
+            _commit_batch(conn.transaction_manager)
+            conn.cacheMinimize()
+        logger.info("Provisioned batch %d of %d sites: %r",
+                    batches, len(batch),
+                    HostSiteProvisioningResult(created, batches, time.time() - begin))
+
+    result = HostSiteProvisioningResult(created, batches, time.time() - begin)
+    logger.info("Finished provisioning host sites: %r", result)
+    return result
+
+
+def remove_host_sites(site_names, registry=None):
+    """
+    Remove the persistent host sites named in *site_names*, along
+    with the registrations of their global ``IComponents``.
+
+    Removing a single site from the :class:`~.HostSitesFolder`
+    unregisters its components from the current site manager (see
+    :func:`nti.site.subscribers._on_site_removed`), and each
+    unregistration invalidates the registry and everything that
+    depends on it. When retiring many sites at once, this removes
+    them in the same way, one at a time, but the registries of
+    persistent site managers with
+    :meth:`~.BTreeLocalAdapterRegistry.coalescedChanges` (such as
+    :class:`~.BTreeLocalSiteManager`) and of the given *registry*
+    (including the global site manager) are invalidated only once,
+    after all the sites are removed. See
+    :func:`~.coalesced_registry_changes` for what that means for other
+    threads using the global site manager meanwhile.
+
+    Sites are removed descendants first. Names that aren't in the
+    host sites folder are ignored.
+
+    :keyword registry: A site manager to also unregister the components
+        from, after each site is removed. Pass the global site manager
+        to unregister globally registered components.
+    :return: The names of the sites removed, in the order they were removed.
+    :rtype: list
+
+    .. versionadded:: 3.2.0
+    """
+    sites = component.getUtility(IEtcNamespace, name='hostsites')
+    names = [name for name in set(site_names) if name in sites]
+    if sites.parentIndex is None:
+        sites.rebuildChildrenIndex()
+    names.sort(key=lambda name: (-_host_site_depth(sites, name), name))
+
+    site_managers = [component.getSiteManager()]
+    if registry is not None and registry is not site_managers[0]:
+        site_managers.append(registry)
+    with ExitStack() as stack:
+        for site_manager in site_managers:
+            stack.enter_context(coalesced_registry_changes(site_manager.utilities))
+        for name in names:
+            # Fires the removal event, which unregisters from the
+            # current site manager.
+            del sites[name]
+            if registry is not None:
+                site_components = registry.queryUtility(IComponents, name=name)
+                if site_components is not None:
+                    registry.unregisterUtility(site_components, IComponents, name=name)
+    logger.info("Removed %d host sites", len(names))
+    return names
+
+
+def _host_site_depth(sites, name):
+    depth = 0
+    while name:
+        name = sites.parentIndex.get(name, '')
+        depth += 1
+    return depth
+
+
+def _host_site_name(site_manager):
+    # The name of the host site owning the persistent *site_manager*, or
+    # None if it's the main application site manager.
+    site = site_manager.__parent__
+    # pylint:disable-next=no-value-for-parameter
+    return site.__name__ if IHostPolicyFolder.providedBy(site) else None
 
 
 def install_sites_folder(server_folder):
@@ -377,7 +623,43 @@ def get_all_host_sites():
                 ordered.append(base_site)
     return ordered
 
-def run_job_in_all_host_sites(func):
+def get_host_site_children(site):
+    """
+    Return the host sites that directly descend from the host *site*.
+
+    Only the child sites are loaded; this uses the index maintained
+    by the :class:`~.HostSitesFolder`.
+
+    :param site: Either the site object itself, or its unique name.
+    :rtype: list
+
+    .. versionadded:: 3.2.0
+    """
+    sites = component.getUtility(IEtcNamespace, name='hostsites')
+    name = site if isinstance(site, string_types) else site.__name__
+    return [sites[child_name] for child_name in sites.getChildSiteNames(name)]
+
+def iter_host_site_subtree(site):
+    """
+    Iterate the host *site* and all the host sites descending from it.
+
+    As with :func:`get_all_host_sites`, sites are produced top-down and
+    breadth-first, so parents always come before their children.
+    Only the sites in the subtree are loaded.
+
+    :param site: Either the site object itself, or its unique name.
+
+    .. versionadded:: 3.2.0
+    """
+    site = get_host_site(site) if isinstance(site, string_types) else site
+    pending = deque([site])
+    while pending:
+        site = pending.popleft()
+        yield site
+        pending.extend(get_host_site_children(site))
+
+def run_job_in_all_host_sites(func, checkpoint=None, root_site=None,
+                              commit_every=None, cache_gc=False):
     """
     While already operating inside of a transaction and the application
     environment, execute the callable given by ``func`` once for each
@@ -390,19 +672,126 @@ def run_job_in_all_host_sites(func):
 
     You are responsible for transaction management.
 
+    .. seealso:: :func:`iter_job_in_all_host_sites` for a variant that
+       doesn't accumulate results and can keep memory bounded.
+
+    :keyword checkpoint: If given, an :class:`~.IHostSiteJobCheckpoint`.
+        Sites it reports as completed are skipped, and each site is
+        marked completed (in the current transaction) after the callable
+        returns. Results are only returned for the sites run this time.
+        See :mod:`nti.site.checkpoint` for implementations.
+
+        .. note:: The marks are committed or aborted together with
+           the work done by the callable. If every site is run in the
+           caller's transaction and the job dies partway, the transaction
+           is aborted and nothing is recorded. To be able to resume an
+           interrupted job, also pass *commit_every*, so that finished
+           sites (and their marks) are committed as the job goes.
+    :keyword root_site: If given, the host site (or its name) whose
+        subtree the job is restricted to. See :func:`iter_host_site_subtree`.
+    :keyword int commit_every: As for :func:`iter_job_in_all_host_sites`.
+    :keyword bool cache_gc: As for :func:`iter_job_in_all_host_sites`.
+
     :raises: Whatever the callable raises.
     :returns: A list of pairs `(site, result)` containing each site
         and the result of running the function in that site.
     :rtype: list
+
+    .. versionchanged:: 3.2.0
+       Add the *checkpoint*, *root_site*, *commit_every* and *cache_gc*
+       arguments.
     """
 
     logger.debug("Asked to run job %s in ALL sites", func)
+    return list(iter_job_in_all_host_sites(func, commit_every=commit_every, cache_gc=cache_gc,
+                                           checkpoint=checkpoint, root_site=root_site))
 
-    results = []
-    ordered = get_all_host_sites()
-    for site in ordered:
-        results.append(run_job_in_host_site(site, func))
-    return results
+# pylint:disable-next=too-many-positional-arguments
+def iter_job_in_all_host_sites(func, commit_every=None, cache_gc=False, checkpoint=None,
+                               root_site=None):
+    """
+    Like :func:`run_job_in_all_host_sites`, but a generator that
+    yields each pair `(site, result)` as soon as the callable has been
+    run in that site.
+
+    When running a job across many thousands of sites, every site
+    touched would otherwise stay in the pickle cache of the connection
+    until the transaction ends. The keyword arguments can be used to keep
+    the memory usage flat no matter the number of sites. They only apply when the
+    host sites folder is persistent.
+
+    Sites are loaded one at a time, as they are reached, by walking the
+    index of children kept by the :class:`~.HostSitesFolder`. (If the
+    index doesn't cover every site, for example in a database that hasn't
+    been synchronized since it was introduced, all the sites are loaded
+    first, as :func:`get_all_host_sites` does.)
+
+    :keyword int commit_every: If given, the transaction of the
+        connection holding the sites is committed after
+        every *commit_every* sites, and the pickle cache of the connection is
+        minimized (``cacheMinimize``). If the transaction manager is in
+        explicit mode, a new transaction is begun. Any sites remaining
+        after the last multiple are left for the caller to commit.
+    :keyword bool cache_gc: If true, then the pickle cache of the connection
+        is garbage collected (``cacheGC``) after each site that doesn't
+        cause a commit.
+    :keyword checkpoint: As for :func:`run_job_in_all_host_sites`. When
+        used with *commit_every*, a job that dies partway can be run again
+        with the same checkpoint to resume after the last commit.
+    :keyword root_site: As for :func:`run_job_in_all_host_sites`.
+
+    .. versionadded:: 3.2.0
+    """
+    sites_folder = component.getUtility(IEtcNamespace, name='hostsites')
+    conn = getattr(sites_folder, '_p_jar', None)
+    if root_site is not None:
+        names = (site.__name__ for site in iter_host_site_subtree(root_site))
+    else:
+        names = _iter_all_host_site_names(sites_folder)
+
+    count = skipped = 0
+    for name in names:
+        if checkpoint is not None and checkpoint.is_completed(name):
+            skipped += 1
+            continue
+        count += 1
+        site = sites_folder[name]
+        result = run_job_in_host_site(site, func)
+        if checkpoint is not None:
+            checkpoint.mark_completed(site.__name__)
+        if conn is not None:
+            if commit_every and count % commit_every == 0:
+                _commit_batch(conn.transaction_manager)
+                conn.cacheMinimize()
+            elif cache_gc:
+                conn.cacheGC()
+        yield site, result
+
+    if skipped:
+        logger.info("Resumed job %s; skipped %d completed sites", func, skipped)
+
+def _iter_all_host_site_names(sites):
+    # The names of all the host sites, top-down and breadth-first like
+    # get_all_host_sites. If walking the index of children reaches every
+    # site, use that, so sites are only loaded as the caller gets to
+    # them. Otherwise (for example, the index doesn't cover sites created
+    # before it existed), fall back to loading them all up front.
+    names = []
+    if sites.childrenIndex is not None:
+        pending = deque(sites.getChildSiteNames(''))
+        while pending:
+            name = pending.popleft()
+            names.append(name)
+            pending.extend(sites.getChildSiteNames(name))
+
+    if len(names) != len(sites):
+        names = [site.__name__ for site in get_all_host_sites()]
+    return names
+
+def _commit_batch(transaction_manager):
+    transaction_manager.commit()
+    if getattr(transaction_manager, 'explicit', False):
+        transaction_manager.begin()
 
 def get_host_site(site_name, safe=False):
     """
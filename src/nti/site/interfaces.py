@@ -12,6 +12,8 @@ __docformat__ = "restructuredtext en"
 logger = __import__('logging').getLogger(__name__)
 from zope import interface
 
+from ZODB.POSException import ReadOnlyError
+
 from zope.site.interfaces import IFolder
 from zope.site.interfaces import ILocalSiteManager
 
@@ -42,6 +44,23 @@ class SiteNotInstalledError(AssertionError):
     """
 
 
+class JobTimeoutError(TimeoutError):
+    """
+    Raised when a job run by :func:`nti.site.runner.run_job_in_site`
+    runs out of time. The job's transaction is aborted.
+
+    .. versionadded:: 3.2.0
+    """
+
+
+class ReadOnlyJobError(ReadOnlyError):
+    """
+    Raised when a job run in read-only mode tries to change something.
+
+    .. versionadded:: 3.2.0
+    """
+
+
 class IMainApplicationFolder(IFolder):
     """
     The folder representing the application. The set of persistent
@@ -100,7 +119,9 @@ class ISiteTransactionRunner(interface.Interface):
 
     # pylint:disable-next=too-many-positional-arguments
     def __call__(func, retries=0, sleep=None, site_names=(), side_effect_free=False,
-                 root_folder_name='nti.dataserver'):
+                 root_folder_name='nti.dataserver', connection_cache=None,
+                 read_only=False, at=None, prefetch=(), retry_policy=None,
+                 deadline=None):
         """
         Runs the function given in `func` in a transaction and application local
         site manager (defaulting to the current site manager).
@@ -135,13 +156,138 @@ class ISiteTransactionRunner(interface.Interface):
             to be committed; the transaction runner is free to abort/rollback
             or commit the transaction at its leisure.
 
+            .. versionchanged:: 3.2.0
+               Otherwise, if the host sites folder is lazy (see
+               :func:`nti.site.hostpolicy.synchronize_host_policies`),
+               a persistent host site that hasn't been created yet is
+               created (in this transaction) when the site is resolved.
+
         :keyword str root_folder_name: This names the folder that can be found in the
             root of the ZODB that will serve as the starting point to look for the
             persistent named site.
 
+        :keyword connection_cache: If given, a
+            :class:`nti.site.runner.WarmConnectionCache` that supplies
+            the connection to use. The connection is kept open for later
+            jobs in the same thread instead of being closed.
+
+            .. versionadded:: 3.2.0
+
+        :keyword bool read_only: If true (not the default), run the
+            function in read-only mode: no transaction note is
+            generated, the transaction is always aborted instead of
+            committed, and if the function changes any persistent
+            object (or otherwise joins a data manager to the transaction),
+            :class:`ReadOnlyJobError` is raised.
+
+            .. versionadded:: 3.2.0
+
+        :keyword at: If given, a :class:`datetime.datetime` or transaction
+            id. The function is run in read-only mode in a historical
+            connection that sees the database as it was at that time.
+            This cannot be combined with *connection_cache*.
+
+            .. versionadded:: 3.2.0
+
+        :keyword prefetch: A sequence of the persistent objects the
+            function is going to use. Each item is an OID (bytes), a
+            ``/`` separated path of keys starting at the root of the
+            database, or an interface naming a utility in the site.
+            Before the function is called, these and the registries of
+            the site manager are passed to
+            :meth:`ZODB.Connection.Connection.prefetch`, so storages
+            that support it (such as RelStorage) can load them
+            together. Paths and utilities are only resolved through
+            objects that have already been loaded, so the objects
+            needed at each level of nesting are prefetched together,
+            one round-trip per level. Items that can't be found are
+            ignored. How many objects were prefetched, and how many
+            were loaded while the function ran, are reported to the
+            :class:`IJobMetricsSink` (and logged at debug level).
+
+            .. versionadded:: 3.2.0
+
+        :keyword retry_policy: If given, a
+            :class:`nti.site.runner.AdaptiveRetryPolicy` that chooses how
+            long to wait before each retry, instead of *sleep*.
+
+            .. versionadded:: 3.2.0
+
+        :keyword float deadline: If given, the number of seconds the job
+            may take, in total, over all its attempts. Once that has
+            passed, no more attempts are made, and
+            :class:`JobTimeoutError` is raised instead. Waits between
+            attempts are shortened to end by the deadline. Long-running
+            functions should call :func:`nti.site.runner.check_job_deadline`
+            periodically to stop early.
+
+            .. versionadded:: 3.2.0
+
+        If an :class:`IJobMetricsSink` utility is registered when this
+        is called, the job is reported to it when it finishes.
+
         :return: The value returned by the first successful invocation of `func`.
         """
 
+class IJobMetricsSink(interface.Interface):
+    """
+    A utility that receives measurements of the jobs run by
+    :func:`nti.site.runner.run_job_in_site`.
+
+    .. seealso:: :class:`nti.site.metrics.InMemoryJobMetrics`
+    .. versionadded:: 3.2.0
+    """
+
+    # pylint:disable-next=too-many-positional-arguments
+    def record_job(job_name, site_name, succeeded, attempts, conflicts,
+                   handler_time, commit_time, total_time, prefetched=0, loaded=0):
+        """
+        Record that a job has finished.
+
+        :param str job_name: The name of the job (or its function).
+        :param str site_name: The name of the site it ran in.
+        :param bool succeeded: Whether the job completed without raising.
+        :param int attempts: How many times the job was run.
+        :param dict conflicts: Maps the names of the types of retryable
+            exceptions (such as ``ConflictError``) raised by failed
+            attempts to how many times each was raised.
+        :param float handler_time: Seconds spent running the job, over all attempts.
+        :param float commit_time: Seconds spent committing, over all attempts.
+        :param float total_time: Seconds from start to finish.
+        :param int prefetched: How many objects were prefetched for the
+            job, over all attempts.
+        :param int loaded: How many objects were loaded from the storage
+            while the job ran, over all attempts.
+        """
+
+
+class IHostSiteJobCheckpoint(interface.Interface):
+    """
+    Records which host sites a job run across all sites has finished,
+    so that an interrupted job can be resumed.
+
+    .. seealso:: :func:`nti.site.hostpolicy.run_job_in_all_host_sites`
+    .. versionadded:: 3.2.0
+    """
+
+    def is_completed(site_name):
+        """
+        Has the job already been completed for the site named *site_name*?
+        """
+
+    def mark_completed(site_name):
+        """
+        Record that the job has completed for the site named *site_name*.
+
+        This is called within the transaction that ran the job; implementations
+        should only make the record permanent if that transaction commits.
+        """
+
+    def clear(): # pylint:disable=no-method-argument
+        """
+        Forget all completed sites.
+        """
+
 class ISiteMapping(interface.Interface):
     """
     Maps a site name to an alternate site. Useful when we do not want full
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Collecting measurements of jobs run in sites.
+
+Register an :class:`~.IJobMetricsSink` utility, such as
+:class:`InMemoryJobMetrics`, and :func:`nti.site.runner.run_job_in_site`
+reports each job to it.
+
+.. versionadded:: 3.2.0
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import threading
+
+from zope import interface
+
+from nti.site.interfaces import IJobMetricsSink
+
+__all__ = [
+    'JobStats',
+    'InMemoryJobMetrics',
+]
+
+
+class JobStats(object):
+    """
+    The totals for one job name in one site.
+    """
+
+    def __init__(self):
+        self.jobs = 0
+        self.failures = 0
+        self.attempts = 0
+        #: Maps exception type names to counts.
+        self.conflicts = {}
+        self.handler_time = 0.0
+        self.commit_time = 0.0
+        self.total_time = 0.0
+        self.max_total_time = 0.0
+        self.prefetched = 0
+        self.loaded = 0
+
+    def __repr__(self):
+        return "<%s jobs=%d failures=%d attempts=%d conflicts=%r>" % (
+            type(self).__name__, self.jobs, self.failures, self.attempts, self.conflicts
+        )
+
+
+def _label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@interface.implementer(IJobMetricsSink)
+class InMemoryJobMetrics(object):
+    """
+    Keeps running totals of the jobs reported to it, per job name and
+    site name, and can produce them in the Prometheus text exposition
+    format.
+
+    This is safe to use from multiple threads.
+    """
+
+    #: The prefix of the Prometheus metric names.
+    prefix = 'nti_site_job'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    # pylint:disable-next=too-many-positional-arguments
+    def record_job(self, job_name, site_name, succeeded, attempts, conflicts,
+                   handler_time, commit_time, total_time, prefetched=0, loaded=0):
+        key = (job_name or '', site_name or '')
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = JobStats()
+            stats.jobs += 1
+            if not succeeded:
+                stats.failures += 1
+            stats.attempts += attempts
+            for kind, count in conflicts.items():
+                stats.conflicts[kind] = stats.conflicts.get(kind, 0) + count
+            stats.handler_time += handler_time
+            stats.commit_time += commit_time
+            stats.total_time += total_time
+            stats.max_total_time = max(stats.max_total_time, total_time)
+            stats.prefetched += prefetched
+            stats.loaded += loaded
+
+    def get(self, job_name, site_name):
+        """
+        Return the :class:`JobStats` for the job and site, or None.
+        """
+        return self._stats.get((job_name, site_name))
+
+    def reset(self):
+        """
+        Forget everything recorded.
+        """
+        with self._lock:
+            self._stats = {}
+
+    def to_prometheus(self):
+        """
+        Return the totals in the Prometheus text exposition format.
+        """
+        with self._lock:
+            items = sorted(self._stats.items())
+
+        lines = []
+        def family(name, kind, doc, values):
+            name = self.prefix + '_' + name
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in values:
+                labels = ','.join('%s="%s"' % (k, _label_value(v)) for k, v in labels)
+                lines.append('%s{%s} %s' % (name, labels, repr(value)))
+
+        def per_job(attr):
+            return [((('job', job), ('site', site)), getattr(stats, attr))
+                    for (job, site), stats in items]
+
+        family('runs_total', 'counter', 'Jobs run.', per_job('jobs'))
+        family('failures_total', 'counter', 'Jobs that raised an exception.',
+               per_job('failures'))
+        family('attempts_total', 'counter', 'Attempts made to run jobs.',
+               per_job('attempts'))
+        family('conflicts_total', 'counter', 'Retryable errors, by type.',
+               [((('job', job), ('site', site), ('type', kind)), count)
+                for (job, site), stats in items
+                for kind, count in sorted(stats.conflicts.items())])
+        family('handler_seconds_total', 'counter', 'Time spent running jobs.',
+               per_job('handler_time'))
+        family('commit_seconds_total', 'counter', 'Time spent committing jobs.',
+               per_job('commit_time'))
+        family('latency_seconds_total', 'counter', 'Total time taken by jobs.',
+               per_job('total_time'))
+        family('latency_seconds_max', 'gauge', 'The longest time taken by a job.',
+               per_job('max_total_time'))
+        family('prefetched_objects_total', 'counter', 'Objects prefetched for jobs.',
+               per_job('prefetched'))
+        family('loaded_objects_total', 'counter', 'Objects loaded by jobs.',
+               per_job('loaded'))
+        return '\n'.join(lines) + '\n'
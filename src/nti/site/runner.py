@@ -8,26 +8,48 @@ Helpers for running jobs in specific sites.
 from __future__ import print_function, absolute_import, division
 __docformat__ = "restructuredtext en"
 
+import logging
+import random
+import sys
+import threading
+import time
 import warnings
 
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from contextvars import copy_context
+
 
 from zope import component
 from zope import interface
 
 from zope.component.hooks import site as current_site
+from zope.component.hooks import setSite
+
+from zope.interface.interfaces import IInterface
 
 from ZODB.interfaces import IDatabase
+from ZODB.utils import z64
 
 from nti.transactions.loop import TransactionLoop
 
+from nti.site.interfaces import SiteNotFoundError
 from nti.site.interfaces import SiteNotInstalledError
 
+from nti.site.interfaces import JobTimeoutError
+from nti.site.interfaces import ReadOnlyJobError
+from nti.site.interfaces import IJobMetricsSink
 from nti.site.interfaces import ITransactionSiteNames
 from nti.site.interfaces import ISiteTransactionRunner
 
+from nti.site.hostpolicy import materialize_host_site
+
+from nti.site.site import find_site_components
 from nti.site.site import get_site_for_site_names
 
-logger = __import__('logging').getLogger(__name__)
+from nti.site.transient import HostLookupSiteManager
+
+logger = logging.getLogger(__name__)
 
 
 # transaction >= 2 < 2.1.1 needs text; Transaction 1 wants
@@ -37,18 +59,441 @@ def _tx_string(s):
     return s.decode('utf-8', 'replace') if isinstance(s, bytes) else s
 
 
+class WarmConnectionCache(threading.local):
+    """
+    Keeps one open ZODB connection per thread for use by successive
+    calls to :func:`run_job_in_site`, so the pickle cache stays warm
+    between jobs instead of being discarded when the connection is
+    closed.
+
+    A single instance is meant to be shared by all the worker threads;
+    each thread sees only its own connection. The connection remains
+    registered with the transaction manager, so it is synchronized
+    with the storage when each job begins its transaction, just like
+    a newly opened connection.
+
+    .. caution:: Each thread's connection is not returned to the
+       database's pool while it is cached. Size the pool accordingly.
+
+    .. versionadded:: 3.2.0
+    """
+
+    def __init__(self, max_idle=60.0, max_jobs=1000):
+        """
+        :keyword float max_idle: If a connection hasn't been used in this
+            many seconds, it is closed and a new one opened for the next job.
+        :keyword int max_jobs: A connection is closed after it has been
+            used for this many jobs.
+        """
+        super().__init__()
+        self.max_idle = max_idle
+        self.max_jobs = max_jobs
+        self.connection = None
+        self.last_used = 0
+        self.jobs = 0
+
+    def open(self, db, transaction_manager):
+        """
+        Return the cached connection for this thread, opening one
+        from *db* with *transaction_manager* if there is none or it
+        can't be used.
+        """
+        conn = self.connection
+        if conn is not None and (conn.opened is None
+                                 or conn.db() is not db
+                                 or conn.transaction_manager is not transaction_manager
+                                 or time.time() - self.last_used > self.max_idle):
+            self.close()
+            conn = None
+        if conn is None:
+            conn = self.connection = db.open(transaction_manager)
+            self.jobs = 0
+        return conn
+
+    def release(self, connection):
+        """
+        Note that a job is done with *connection*, closing it if it has
+        been used for too many jobs.
+        """
+        if connection is not self.connection: # pragma: no cover
+            connection.close()
+            return
+        self.jobs += 1
+        self.last_used = time.time()
+        if self.jobs >= self.max_jobs:
+            self.close()
+
+    def close(self):
+        """
+        Close this thread's connection, if any.
+        """
+        conn, self.connection = self.connection, None
+        if conn is not None and conn.opened is not None:
+            conn.close()
+
+
+def _committed_oid(obj, conn):
+    # The OID of *obj* if it's a persistent object already committed
+    # in *conn*, else None.
+    if getattr(obj, '_p_jar', None) is not conn:
+        return None
+    if getattr(obj, '_p_serial', z64) == z64:
+        return None
+    # The _p_ attributes are the public API of persistent objects.
+    return obj._p_oid # pylint:disable=protected-access
+
+
+#: The time (from :func:`time.monotonic`) by which the current job
+#: must finish, or None.
+_job_deadline = ContextVar('nti.site.runner.job_deadline', default=None)
+
+def check_job_deadline():
+    """
+    Raise :class:`~.JobTimeoutError` if the job being run by
+    :func:`run_job_in_site` has passed its *deadline*.
+
+    Jobs that may run for a long time can call this periodically, for
+    example in each iteration of a loop, to give up promptly. It does
+    nothing if the job has no deadline or if no job is running.
+
+    .. versionadded:: 3.2.0
+    """
+    deadline = _job_deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise JobTimeoutError("Job deadline exceeded")
+
+
+def _ghost_oids(conn, *objects):
+    # The OIDs of those of *objects* that are ghosts from *conn*.
+    # Checking doesn't activate them. The _p_ attributes are the public
+    # API of persistent objects.
+    # pylint:disable=protected-access
+    return [obj._p_oid for obj in objects
+            if getattr(obj, '_p_jar', None) is conn and obj._p_changed is None]
+
+
+# Each item to prefetch is resolved by a generator. It yields a list
+# of the OIDs of the ghosts it must look inside of (or that it names)
+# and is resumed once they have been prefetched.
+
+def _resolve_oid(_conn, oid):
+    yield [oid]
+
+
+def _resolve_path(conn, path):
+    obj = conn.root()
+    for name in path.strip('/').split('/'):
+        oids = _ghost_oids(conn, obj)
+        if oids:
+            yield oids
+        try:
+            obj = obj[name]
+        except (KeyError, TypeError):
+            return
+    oids = _ghost_oids(conn, obj)
+    if oids:
+        yield oids
+
+
+def _resolve_utility(conn, site_manager, provided):
+    utilities = site_manager.utilities
+    oids = _ghost_oids(conn, utilities)
+    if oids:
+        yield oids
+    oids = _ghost_oids(conn, *utilities.ro)
+    if oids:
+        yield oids
+    oids = _ghost_oids(conn, site_manager.queryUtility(provided))
+    if oids:
+        yield oids
+
+
+def _resolve_registries(conn, site_manager):
+    oids = _ghost_oids(conn, getattr(site_manager, 'adapters', None),
+                       getattr(site_manager, 'utilities', None))
+    if oids:
+        yield oids
+
+
+def _prefetch_objects(conn, site_manager, spec):
+    # Prefetch what *spec* (see ISiteTransactionRunner) names, plus the
+    # registries of the (current) *site_manager*, and return how many
+    # objects were prefetched.
+    #
+    # Items are only resolved through objects that are already loaded.
+    # The ghosts in the way of all the items are prefetched together,
+    # and then resolution continues, so each level of nesting costs one
+    # round-trip instead of one per object. (Looking inside an object
+    # may still load persistent objects it doesn't expose, such as the
+    # buckets of a large BTree.)
+    resolvers = [_resolve_registries(conn, site_manager)]
+    for item in spec:
+        if isinstance(item, bytes):
+            resolvers.append(_resolve_oid(conn, item))
+        elif IInterface.providedBy(item):
+            resolvers.append(_resolve_utility(conn, site_manager, item))
+        else:
+            resolvers.append(_resolve_path(conn, item))
+
+    prefetched = set()
+    while resolvers:
+        oids = []
+        waiting = []
+        for resolver in resolvers:
+            for oid in next(resolver, ()):
+                if oid not in prefetched:
+                    prefetched.add(oid)
+                    oids.append(oid)
+            waiting.append(resolver)
+        if not oids:
+            break
+        conn.prefetch(oids)
+        resolvers = waiting
+    return len(prefetched)
+
+
+class AdaptiveRetryPolicy(object):
+    """
+    Chooses how long :func:`run_job_in_site` waits before retrying a
+    job that failed with a retryable error such as a
+    :class:`~ZODB.POSException.ConflictError`.
+
+    The wait is chosen at random (with "full jitter") between zero
+    and a limit that doubles with each retry of the job, starting at
+    *base* and capped at *maximum*. The limit is also scaled up for
+    sites that are frequently in conflict: the policy keeps an
+    exponentially weighted moving average of the rate at which
+    attempts to run jobs in each site conflict, and multiplies the
+    limit by ``1 + contention_factor * rate``. Jobs in busy sites
+    thus spread out further, while jobs in quiet sites retry quickly.
+
+    One instance should be shared by all the jobs it is to learn from;
+    it is safe to use from multiple threads. Pass it as
+    ``run_job_in_site(retry_policy=...)``.
+
+    .. versionadded:: 3.2.0
+    """
+
+    # pylint:disable-next=too-many-positional-arguments
+    def __init__(self, base=0.01, maximum=2.0, contention_factor=4.0,
+                 smoothing=0.2, random_source=None):
+        """
+        :keyword float base: The limit, in seconds, for the first retry.
+        :keyword float maximum: The largest limit, in seconds.
+        :keyword float contention_factor: How much the conflict rate of
+            a site scales the limit.
+        :keyword float smoothing: The weight given to each new attempt
+            in the moving average, between 0 and 1.
+        """
+        self.base = base
+        self.maximum = maximum
+        self.contention_factor = contention_factor
+        self.smoothing = smoothing
+        self.random = random_source or random.Random()
+        self._lock = threading.Lock()
+        self._conflict_rates = {}
+
+    def conflict_rate(self, site_name):
+        """
+        Return the estimated fraction (between 0 and 1) of attempts to
+        run jobs in the site that end in a retryable error.
+        """
+        return self._conflict_rates.get(site_name, 0.0)
+
+    def record_attempt(self, site_name, conflicted):
+        """
+        Update the estimate for the site after an attempt.
+        """
+        with self._lock:
+            rate = self._conflict_rates.get(site_name, 0.0)
+            rate += self.smoothing * (float(conflicted) - rate)
+            self._conflict_rates[site_name] = rate
+
+    def delay(self, site_name, retry_number):
+        """
+        Return the number of seconds to wait before the *retry_number*
+        retry (starting at 1) of a job in the site.
+        """
+        limit = self.base * 2 ** (retry_number - 1)
+        limit *= 1 + self.contention_factor * self.conflict_rate(site_name)
+        return self.random.uniform(0, min(limit, self.maximum))
+
+
+def _materialize_lazy_host_site(site):
+    # If *site* stands in for a host site that a lazy host sites folder
+    # hasn't created yet (see synchronize_host_policies), create it
+    # and return it. Otherwise, return *site*.
+    site_manager = site.getSiteManager()
+    if not isinstance(site_manager, HostLookupSiteManager):
+        return site
+    main_site = site.__parent__
+    try:
+        sites = main_site['++etc++hostsites']
+    except (KeyError, TypeError):
+        return site
+    if not getattr(sites, 'lazyHostSites', False):
+        return site
+    with current_site(main_site):
+        return materialize_host_site(site_manager.host_components, sites)
+
+
+class _JobMetrics(object):
+    # Measurements of one call of a _RunJobInSite, for an IJobMetricsSink.
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.site_name = ''
+        self.attempts = 0
+        self.conflicts = {}
+        self.handler_time = 0.0
+        self.commit_time = 0.0
+        self.prefetched = 0
+        self.loaded = 0
+        self._commit_started = None
+
+    def began_attempt(self, site_name, tx):
+        self.attempts += 1
+        self.site_name = site_name
+        tx.addBeforeCommitHook(self._before_commit)
+        tx.addAfterCommitHook(self._after_commit)
+
+    def _before_commit(self):
+        self._commit_started = time.perf_counter()
+
+    def _after_commit(self, _status):
+        if self._commit_started is not None:
+            self.commit_time += time.perf_counter() - self._commit_started
+            self._commit_started = None
+
+    def handled(self, handler_time, prefetched, loaded):
+        self.handler_time += handler_time
+        self.prefetched += prefetched
+        self.loaded += loaded
+
+    def retryable_error(self, kind):
+        name = kind.__name__
+        self.conflicts[name] = self.conflicts.get(name, 0) + 1
+
+    def report(self, sink, job_name, succeeded):
+        try:
+            sink.record_job(job_name, self.site_name, succeeded, self.attempts,
+                            self.conflicts, self.handler_time, self.commit_time,
+                            time.perf_counter() - self.started,
+                            prefetched=self.prefetched, loaded=self.loaded)
+        except Exception: # pylint:disable=broad-exception-caught
+            logger.exception("Failed to record metrics for job %r in %s", job_name, sink)
+
+
+class _RetryBackoff(object):
+    # Stands in for TransactionLoop.random. The loop asks it for the
+    # multiple of TransactionLoop.sleep to wait before a retry; with
+    # that set to 1, the answer is the delay in seconds chosen by
+    # *retry_delay* (the job's retry policy, or the loop's usual
+    # backoff, limited by the job's deadline). The loop then notifies
+    # WillSleepBetweenAttempts with it, so subscribers can still
+    # change how long it sleeps.
+
+    def __init__(self, sleep, random_, retry_delay):
+        self._sleep = sleep
+        self._random = random_
+        self._retry_delay = retry_delay
+
+    def randint(self, low, high):
+        def backoff():
+            return self._sleep * self._random.randint(low, high)
+        return self._retry_delay(backoff)
+
+
+class _JobOptions(object):
+    # The optional behaviour of a _RunJobInSite. See run_job_in_site.
+
+    __slots__ = (
+        'connection_cache',
+        'read_only',
+        'at',
+        'prefetch',
+        'retry_policy',
+        'deadline',
+    )
+
+    def __init__(self, *, connection_cache=None, read_only=False, at=None,
+                 prefetch=(), retry_policy=None, deadline=None):
+        self.connection_cache = connection_cache
+        self.at = at
+        # Historical connections can't write.
+        self.read_only = read_only or at is not None
+        self.prefetch = prefetch
+        self.retry_policy = retry_policy
+        self.deadline = deadline
+
+
+class _JobCall(object):
+    # The state of one call of a _RunJobInSite, kept across its attempts.
+
+    __slots__ = (
+        'root_oid',
+        'site_oid',
+        'site_name',
+        'retries',
+        'metrics',
+    )
+
+    def __init__(self):
+        self.root_oid = None
+        self.site_oid = None
+        self.site_name = ''
+        self.retries = 0
+        #: The _JobMetrics, if there's a sink to report to.
+        self.metrics = None
+
+
 class _RunJobInSite(TransactionLoop):
+    """
+    .. versionchanged:: 3.2.0
+       Only resolve the site by name on the first attempt; retries
+       load the persistent site from the connection by OID.
+    .. versionchanged:: 3.2.0
+       Report each job to the :class:`~.IJobMetricsSink` utility, if any.
+    .. versionchanged:: 3.2.0
+       Add a read-only mode.
+    .. versionchanged:: 3.2.0
+       Add prefetching.
+    .. versionchanged:: 3.2.0
+       Add *retry_policy*.
+    .. versionchanged:: 3.2.0
+       Add *deadline*.
+    .. versionchanged:: 3.2.0
+       Unless side-effect free, create a host site that a lazy host
+       sites folder hasn't created yet.
+    """
 
     _connection = None
+    #: The _JobCall for the current call.
+    _call = None
 
     def __init__(self, *args, **kwargs):
         self.site_names = kwargs.pop('site_names')
         self.job_name = kwargs.pop('job_name')
         self.side_effect_free = kwargs.pop('side_effect_free')
         self.root_folder_name = kwargs.pop('root_folder_name')
+        self.options = options = _JobOptions(**{
+            name: kwargs.pop(name) for name in _JobOptions.__slots__ if name in kwargs
+        })
+        if options.read_only:
+            self.side_effect_free = True
         super().__init__(*args, **kwargs)
+        if options.retry_policy is not None or (self.sleep and options.deadline is not None):
+            # (The loop only has a random if it was given a sleep.)
+            self.random = _RetryBackoff(self.sleep, getattr(self, 'random', None),
+                                        self.retry_delay)
+            # So the multiple chosen by _RetryBackoff is in seconds.
+            # The loop only sleeps if this is set.
+            self.sleep = 1
 
     def describe_transaction(self, *args, **kwargs):
+        if self.options.read_only:
+            # Nothing will be committed, so don't bother.
+            return None
         if self.job_name:
             return _tx_string(self.job_name)
         # Derive from the function
@@ -67,39 +512,193 @@ class _RunJobInSite(TransactionLoop):
 
         return note
 
-    def run_handler(self, *args, **kwargs): # pylint:disable=arguments-differ
-        sitemanc = self._connection.root()[self.root_folder_name]
+    def _metrics_job_name(self):
+        if self.job_name:
+            return _tx_string(self.job_name)
+        func = self.handler
+        return getattr(func, '__name__', None) or type(func).__name__
+
+    def __call__(self, *args, **kwargs):
+        self._call = _JobCall()
+        deadline = self.options.deadline
+        if deadline is None:
+            return self._call_measured(*args, **kwargs)
+
+        token = _job_deadline.set(time.monotonic() + deadline)
+        try:
+            return self._call_measured(*args, **kwargs)
+        finally:
+            _job_deadline.reset(token)
+
+    def _call_measured(self, *args, **kwargs):
+        sink = component.queryUtility(IJobMetricsSink)
+        retry_policy = self.options.retry_policy
+        if sink is None and retry_policy is None:
+            return super().__call__(*args, **kwargs)
+
+        call = self._call
+        if sink is not None:
+            call.metrics = _JobMetrics()
+        succeeded = False
+        try:
+            result = super().__call__(*args, **kwargs)
+            succeeded = True
+            return result
+        finally:
+            if succeeded and retry_policy is not None:
+                retry_policy.record_attempt(call.site_name, False)
+            if sink is not None:
+                call.metrics.report(sink, self._metrics_job_name(), succeeded)
+
+    def _is_retryable(self, tx, exc_info):
+        # Would the loop retry this error? Unlike _retryable, this
+        # has no side effects.
+        return super()._retryable(tx, exc_info)
+
+    def _retryable(self, tx, exc_info):
+        retryable = self._is_retryable(tx, exc_info)
+        if retryable:
+            call = self._call
+            call.retries += 1
+            if call.metrics is not None:
+                call.metrics.retryable_error(exc_info[0])
+            if self.options.retry_policy is not None:
+                self.options.retry_policy.record_attempt(call.site_name, True)
+        return retryable
+
+    def retry_delay(self, backoff):
+        """
+        How many seconds to wait before the next retry, given the
+        usual *backoff* (see :class:`_RetryBackoff`).
+        """
+        retry_policy = self.options.retry_policy
+        if retry_policy is not None:
+            delay = retry_policy.delay(self._call.site_name, self._call.retries)
+        else:
+            delay = backoff()
+        deadline = _job_deadline.get()
+        if deadline is not None:
+            delay = max(0, min(delay, deadline - time.monotonic()))
+        return delay
+
+    def _get_site(self):
+        # Find the site to run in. The first attempt resolves it by name,
+        # remembering the OIDs of the root folder and site if they
+        # are already committed. Retries (using the same connection,
+        # now synchronized) load them directly. Anything created by the
+        # first attempt was aborted with it, so it isn't remembered.
+        conn = self._connection
+        call = self._call
+        if call.site_oid is not None:
+            return conn.get(call.site_oid)
+
+        if call.root_oid is not None:
+            root_folder = conn.get(call.root_oid)
+        else:
+            root_folder = conn.root()[self.root_folder_name]
+            call.root_oid = _committed_oid(root_folder, conn)
+
         # Put into a policy if need be
-        sitemanc = get_site_for_site_names(self.site_names, sitemanc)
+        site = get_site_for_site_names(self.site_names, root_folder)
+        if not self.side_effect_free:
+            # (Which read-only jobs are.)
+            site = _materialize_lazy_host_site(site)
+        call.site_oid = _committed_oid(site, conn)
+        return site
+
+    def run_handler(self, *args, **kwargs): # pylint:disable=arguments-differ
+        options = self.options
+        call = self._call
+        if options.deadline is not None:
+            # Don't start another attempt if we're out of time.
+            check_job_deadline()
+        sitemanc = self._get_site()
+        # A site without a name is the root folder.
+        call.site_name = getattr(sitemanc, '__name__', None) or self.root_folder_name
+        metrics = call.metrics
+        if metrics is not None:
+            metrics.began_attempt(call.site_name,
+                                  self.get_transaction_manager_for_call().get())
 
         with current_site(sitemanc):
             if component.getSiteManager() != sitemanc.getSiteManager():
                 raise SiteNotInstalledError("Hooks not installed?")
-            return self.handler(*args, **kwargs)
+            conn = self._connection
+            prefetched = 0
+            if options.prefetch:
+                prefetched = _prefetch_objects(conn, component.getSiteManager(),
+                                               options.prefetch)
+            loads = conn.getTransferCounts()[0]
+            started = time.perf_counter()
+            try:
+                result = self.handler(*args, **kwargs)
+            finally:
+                loaded = conn.getTransferCounts()[0] - loads
+                if metrics is not None:
+                    metrics.handled(time.perf_counter() - started, prefetched, loaded)
+                if options.prefetch:
+                    logger.debug("Job %r prefetched %d objects and then loaded %d",
+                                 self.handler, prefetched, loaded)
+
+        if options.read_only:
+            self._check_read_only()
+        return result
+
+    def _check_read_only(self):
+        # The ZODB connection joins the transaction when an object is
+        # changed, as do other data managers when they have work to do.
+        tx = self.get_transaction_manager_for_call().get()
+        resources = tx._resources # pylint:disable=protected-access
+        if resources:
+            raise ReadOnlyJobError("Read-only job %r joined data managers %r" % (
+                self.handler, resources))
 
     def setUp(self): # pylint:disable=arguments-differ
         # After the transaction manager has been put into explicit
         # mode, open the connection. This lets it perform certain
         # optimizations.
         db = component.getUtility(IDatabase)
-        self._connection = db.open()
+        options = self.options
+        if options.at is not None:
+            self._connection = db.open(at=options.at)
+        elif options.connection_cache is not None:
+            self._connection = options.connection_cache.open(
+                db,
+                self.get_transaction_manager_for_call())
+        else:
+            self._connection = db.open()
 
     def tearDown(self): # pylint:disable=arguments-differ
         if self._connection is not None:
             try:
-                self._connection.close()
+                if self.options.connection_cache is not None:
+                    self.options.connection_cache.release(self._connection)
+                else:
+                    self._connection.close()
             finally:
                 self._connection = None
 
 
 _marker = object()
 
+#: The site names captured by :mod:`nti.site.asyncrunner` when a job
+#: was submitted, or given to :func:`run_job_in_sites`, set in the
+#: context the job runs in.
+_carried_site_names = ContextVar('nti.site.runner.carried_site_names', default=_marker)
+
 def get_possible_site_names(*args, **kwargs):
     """
     Helper to find the most applicable site names.
 
     This uses the :class:`.ITransactionSiteNames` utility.
+
+    .. versionchanged:: 3.2.0
+       When called by a job submitted through :mod:`nti.site.asyncrunner`,
+       return the site names found when the job was submitted.
     """
+    site_names = _carried_site_names.get()
+    if site_names is not _marker:
+        return site_names
     utility = component.queryUtility(ITransactionSiteNames)
     result = utility(*args, **kwargs) if utility is not None else None
     return result
@@ -112,7 +711,13 @@ def run_job_in_site(func,
                     site_names=_marker,
                     job_name=None,
                     side_effect_free=False,
-                    root_folder_name='nti.dataserver'):
+                    root_folder_name='nti.dataserver',
+                    connection_cache=None,
+                    read_only=False,
+                    at=None,
+                    prefetch=(),
+                    retry_policy=None,
+                    deadline=None):
     """
     Runs the function given in `func` in a transaction and dataserver local
     site manager. See :class:`.ISiteTransactionRunner`
@@ -131,6 +736,9 @@ def run_job_in_site(func,
     else:
         site_names = get_possible_site_names()
 
+    if at is not None and connection_cache is not None:
+        raise TypeError("Cannot use a connection_cache with a historical connection")
+
     return _RunJobInSite(
         func,
         retries=retries,
@@ -138,7 +746,201 @@ def run_job_in_site(func,
         site_names=site_names,
         job_name=job_name,
         side_effect_free=side_effect_free,
-        root_folder_name=root_folder_name
+        root_folder_name=root_folder_name,
+        connection_cache=connection_cache,
+        read_only=read_only,
+        at=at,
+        prefetch=prefetch,
+        retry_policy=retry_policy,
+        deadline=deadline,
     )()
 
 run_job_in_site.__doc__ = ISiteTransactionRunner['__call__'].getDoc()
+
+
+class BatchJobResult(object):
+    """
+    The outcome of one of the callables run by :func:`run_jobs_in_site`,
+    or of the callable run in one of the sites by :func:`run_job_in_sites`.
+
+    .. versionadded:: 3.2.0
+    """
+
+    def __init__(self, func, result=None, exception=None):
+        #: The callable.
+        self.func = func
+        #: What it returned, if it succeeded.
+        self.result = result
+        #: The exception it raised, if it failed. Its changes were
+        #: rolled back.
+        self.exception = exception
+
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+    def __repr__(self):
+        return "<%s %r result=%r exception=%r>" % (
+            type(self).__name__, self.func, self.result, self.exception
+        )
+
+
+class _RunJobsInSite(_RunJobInSite):
+
+    #: Whether the last error raised by the batch was retryable.
+    failed_retryable = False
+
+    def __init__(self, funcs, **kwargs):
+        self.funcs = funcs
+        super().__init__(self._run_jobs, **kwargs)
+
+    def describe_transaction(self, *args, **kwargs):
+        if self.job_name:
+            return _tx_string(self.job_name)
+        return _tx_string('Batch of %d jobs' % (len(self.funcs),))
+
+    def _metrics_job_name(self):
+        return _tx_string(self.job_name) if self.job_name else 'batch'
+
+    def _retryable(self, tx, exc_info):
+        retryable = super()._retryable(tx, exc_info)
+        self.failed_retryable = bool(retryable)
+        return retryable
+
+    def _run_jobs(self):
+        txm = self.get_transaction_manager_for_call()
+        results = []
+        for func in self.funcs:
+            savepoint = txm.savepoint()
+            try:
+                result = BatchJobResult(func, func())
+            except JobTimeoutError:
+                raise
+            except Exception as e: # pylint:disable=broad-exception-caught
+                if self._is_retryable(txm.get(), sys.exc_info()):
+                    # Let the whole transaction be retried.
+                    raise
+                savepoint.rollback()
+                result = BatchJobResult(func, exception=e)
+            results.append(result)
+        return results
+
+
+# pylint:disable-next=too-many-positional-arguments
+def run_jobs_in_site(funcs,
+                     retries=0,
+                     sleep=None,
+                     job_name=None,
+                     root_folder_name='nti.dataserver',
+                     connection_cache=None):
+    """
+    Like :func:`run_job_in_site`, but run each of the callables in
+    *funcs*, in order, in one transaction, amortizing the cost of the
+    commit over all of them.
+
+    Each callable runs inside its own savepoint. If it raises an exception,
+    its changes are rolled back, the exception is recorded in its result,
+    and the remaining callables still run. (Errors that would be retried,
+    such as :class:`~ZODB.POSException.ConflictError` or anything a data
+    manager in the transaction says should be retried, are the exception;
+    they abort the whole transaction.)
+
+    If the transaction still fails with such an error after *retries*
+    retries, the batch is split in half and each half is run (with the
+    same number of retries) in its own transaction, recursively, isolating
+    the conflicting callables. The result of a single callable that
+    can't be committed records the error.
+
+    The other arguments are as for :func:`run_job_in_site`.
+
+    :return: A list of :class:`BatchJobResult`, one for each callable, in order.
+
+    .. versionadded:: 3.2.0
+    """
+    site_names = get_possible_site_names()
+
+    def run(batch):
+        loop = _RunJobsInSite(
+            batch,
+            retries=retries,
+            sleep=sleep,
+            site_names=site_names,
+            job_name=job_name,
+            side_effect_free=False,
+            root_folder_name=root_folder_name,
+            connection_cache=connection_cache,
+        )
+        try:
+            return loop()
+        except Exception as e: # pylint:disable=broad-exception-caught
+            if not loop.failed_retryable:
+                raise
+            if len(batch) == 1:
+                logger.warning("Job %r in batch failed to commit: %r", batch[0], e)
+                return [BatchJobResult(batch[0], exception=e)]
+            middle = len(batch) // 2
+            logger.debug("Batch of %d jobs failed to commit (%r); splitting",
+                         len(batch), e)
+            return run(batch[:middle]) + run(batch[middle:])
+
+    funcs = list(funcs)
+    return run(funcs) if funcs else []
+
+
+def run_job_in_sites(func, site_names, max_workers=None, **kwargs):
+    """
+    Run *func* with :func:`run_job_in_site` once in each of the sites
+    named by *site_names*, concurrently, each in its own transaction
+    and connection.
+
+    Each site is run as if :func:`get_possible_site_names` returned just
+    its name. An exception raised by one site (after any retries) is
+    recorded in its result and doesn't affect the others. A name with
+    no registered :class:`~zope.interface.interfaces.IComponents`
+    (directly or through an :class:`~.ISiteMapping`), which would
+    otherwise be run in the main application site, isn't run; a
+    :class:`~.SiteNotFoundError` is recorded in its result instead.
+
+    :param site_names: The names of the (host) sites.
+    :keyword int max_workers: How many sites to run at once. Defaults to
+        the size of the connection pool of the :class:`~ZODB.interfaces.IDatabase`
+        utility, since each one uses a connection.
+    :keyword kwargs: Passed to :func:`run_job_in_site` (except *site_names*).
+    :return: A dictionary mapping each site name to a :class:`BatchJobResult`.
+
+    .. versionadded:: 3.2.0
+    """
+    site_names = list(site_names)
+    not_found = {
+        site_name: BatchJobResult(func, exception=SiteNotFoundError(site_name))
+        for site_name in site_names
+        if find_site_components((site_name,), check_alternate=True) is None
+        and find_site_components((site_name,)) is None
+    }
+    found = [site_name for site_name in site_names if site_name not in not_found]
+    if not found:
+        return not_found
+    if max_workers is None:
+        max_workers = component.getUtility(IDatabase).getPoolSize()
+    max_workers = min(max_workers, len(found))
+
+    def run(site_name):
+        # The copied context may carry the caller's site (see
+        # nti.site.contextsite), whose objects belong to the caller's
+        # connection. Start with none, like a new thread.
+        setSite(None)
+        _carried_site_names.set((site_name,))
+        try:
+            return BatchJobResult(func, run_job_in_site(func, **kwargs))
+        except Exception as e: # pylint:disable=broad-exception-caught
+            logger.exception("Failed to run job %r in site %r", func, site_name)
+            return BatchJobResult(func, exception=e)
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix='nti.site.runner') as executor:
+        futures = {
+            site_name: executor.submit(copy_context().run, run, site_name)
+            for site_name in found
+        }
+    return {site_name: not_found[site_name] if site_name in not_found
+            else futures[site_name].result()
+            for site_name in site_names}
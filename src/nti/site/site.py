@@ -11,6 +11,10 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
+import threading
+
+from contextlib import contextmanager
+
 from BTrees import family64
 
 from zope import component
@@ -34,7 +38,7 @@ from nti.site.interfaces import ISiteMapping
 from nti.site.interfaces import SiteNotFoundError
 
 from nti.site.transient import TrivialSite
-from nti.site.transient import HostSiteManager
+from nti.site.transient import HostLookupSiteManager
 
 
 from zope.component.persistentregistry import PersistentComponents
@@ -102,6 +106,9 @@ def get_site_for_site_names(site_names, site=None):
     .. versionchanged:: 1.3.0
         Prioritize :class:`ISiteMapping` so that persistent sites can be mapped
         to other persistent sites.
+    .. versionchanged:: 3.2.0
+        The non-persistent site uses a lightweight
+        :class:`~.HostLookupSiteManager`.
     """
 
     if site is None:
@@ -120,10 +127,10 @@ def get_site_for_site_names(site_names, site=None):
         site_name = site_components.__name__
         # Do we have a persistent site installed in the database? If yes,
         # we want to use that.
-        try:
-            pers_site = site['++etc++hostsites'][site_name]
+        pers_site = _find_persistent_site(site, site_components)
+        if pers_site is not None:
             site = pers_site
-        except (KeyError, TypeError):
+        else:
             # No, nothing persistent, dummy one up.
             # Note that this code path is deprecated now and not
             # expected to be hit.
@@ -151,16 +158,26 @@ def get_site_for_site_names(site_names, site=None):
             main_site = site
             # XXX: This easily produces resolution orders that are
             # inconsistent with C3. See test_site.test_no_persistent_site.
-            site_manager = HostSiteManager(main_site.__parent__,
-                                           main_site.__name__,
-                                           site_components,
-                                           main_site.getSiteManager())
+            site_manager = HostLookupSiteManager(main_site.__parent__,
+                                                 main_site.__name__,
+                                                 site_components,
+                                                 main_site.getSiteManager())
             site = TrivialSite(site_manager)
             site.__parent__ = main_site
             site.__name__ = site_name
 
     return site
 
+def _find_persistent_site(site, site_components):
+    # Return the persistent host site for *site_components*
+    # beneath the main application *site*, or None. Lookups never
+    # create sites, even if the host sites folder is lazy; they
+    # may be running in a read-only or side-effect free transaction.
+    try:
+        return site['++etc++hostsites'][site_components.__name__]
+    except (KeyError, TypeError):
+        return None
+
 def get_component_hierarchy(site=None):
     site = getSite() if site is None else site
     # XXX: This is tightly coupled. Note that we assume that the parent
@@ -241,6 +258,41 @@ class BTreeLocalAdapterRegistry(_LocalAdapterRegistry):
     _providedType = btree_family.OI.BTree
     _mappingType = btree_family.OO.BTree
 
+    #: The changes deferred by :meth:`coalescedChanges`, if it's active.
+    _v_nti_deferred_changes = None
+
+    def changed(self, originally_changed):
+        deferred = self._v_nti_deferred_changes
+        if deferred is not None:
+            deferred.append(originally_changed)
+            return
+        super().changed(originally_changed)
+
+    @contextmanager
+    def coalescedChanges(self):
+        """
+        A context manager that collapses all the invalidations of this
+        registry (calls to :meth:`changed`) made in its body into one,
+        made when it exits. Until then, cached lookups in this registry
+        and those based on it may not reflect the changes.
+
+        The pending changes are kept in a volatile attribute, so this
+        only affects this connection's copy of the registry.
+
+        .. versionadded:: 3.2.0
+        """
+        if self._v_nti_deferred_changes is not None:
+            # Nested; the outermost call does the work.
+            yield self
+            return
+        deferred = self._v_nti_deferred_changes = []
+        try:
+            yield self
+        finally:
+            del self._v_nti_deferred_changes
+            if deferred:
+                self.changed(self)
+
     def _addValueToLeaf(self, existing_leaf_sequence, new_item):
         if isinstance(existing_leaf_sequence, tuple):
             # We're mutating unmigrated data. This could lead to data loss
@@ -258,6 +310,50 @@ class BTreeLocalAdapterRegistry(_LocalAdapterRegistry):
                                                                       new_item)
 
 
+#: Held while changes to a registry without ``coalescedChanges`` are
+#: being coalesced. Such registries (like those of the global site
+#: manager) are shared by all threads.
+_coalescing_lock = threading.RLock()
+
+@contextmanager
+def coalesced_registry_changes(registry):
+    """
+    A context manager that collapses all the invalidations of the
+    adapter *registry* (calls to its ``changed`` method, made for each
+    registration and unregistration) in its body into one, made when
+    it exits.
+
+    Registries that have a ``coalescedChanges`` method, like
+    :class:`BTreeLocalAdapterRegistry`, use it. Other registries, like
+    those of the global site manager, are shared by all threads, so
+    while the body runs, their changes made by *any* thread are
+    deferred, and lookups through them (and the registries based on
+    them) may return stale results until it exits. Only one thread at
+    a time can coalesce changes to such a registry; others wait.
+
+    .. versionadded:: 3.2.0
+    """
+    coalesced = getattr(registry, 'coalescedChanges', None)
+    if coalesced is not None:
+        with coalesced():
+            yield registry
+        return
+
+    with _coalescing_lock:
+        if 'changed' in registry.__dict__:
+            # Nested; the outermost call does the work.
+            yield registry
+            return
+        deferred = []
+        registry.changed = deferred.append
+        try:
+            yield registry
+        finally:
+            del registry.changed
+            if deferred:
+                registry.changed(registry)
+
+
 class BTreePersistentComponents(PersistentComponents):
     """
     Persistent components that will be friendly to ZODB when they get large.
@@ -18,11 +18,16 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
+import threading
+
+from contextvars import ContextVar
+
 from zope import component
 
 from zope.component.hooks import getSite
 from zope.component.hooks import setSite
 
+from zope.interface import providedBy
 from zope.interface.interfaces import IComponents
 
 from zope.component.interfaces import ISite
@@ -30,6 +35,7 @@ from zope.component.interfaces import ISite
 from zope.lifecycleevent.interfaces import IObjectRemovedEvent
 
 from zope.proxy import ProxyBase
+from zope.proxy import getProxiedObject
 from zope.proxy import non_overridable
 
 from zope.site.interfaces import IRootFolder
@@ -40,7 +46,8 @@ from zope.traversing.interfaces import IBeforeTraverseEvent
 from nti.site.interfaces import IHostPolicyFolder
 from nti.site.interfaces import IMainApplicationFolder
 
-from nti.site.transient import BasedSiteManager
+from nti.site.transient import LookupSiteManager
+from nti.site.transient import MemoizingSiteManager
 
 from nti.site.utils import unregisterUtility
 
@@ -70,6 +77,275 @@ class _ProxyTraversedSite(ProxyBase):
         raise ValueError("Cannot set site manager on proxy")
 
 
+_memoize_traversal_lookups = ContextVar('nti.site.memoize_traversal_lookups',
+                                        default=False)
+
+def set_memoize_traversal_lookups(memoize):
+    """
+    Set whether the sites installed by :func:`threadSiteSubscriber` in
+    the current request (thread or context) remember the results of
+    utility lookups for as long as they are installed. See
+    :class:`~.MemoizingSiteManager`.
+
+    This is off by default. The setting lasts until it's changed, so
+    an application that wants it should set it at the start of each
+    request (for example, in the tween that installs the host site),
+    and clear it at the end. It is only safe if the request doesn't
+    expect registrations it makes to be visible through the current
+    site.
+
+    :return: The previous setting.
+
+    .. versionadded:: 3.2.0
+    """
+    previous = _memoize_traversal_lookups.get()
+    _memoize_traversal_lookups.set(bool(memoize))
+    return previous
+
+#: The volatile attribute of a traversed site manager caching the
+#: proxy site managers built from it.
+_PROXY_CACHE_ATTR = '_v_nti_site_traversal_proxies'
+
+
+class _ProxySiteManagerCache(threading.local):
+    # Non-persistent site managers are shared between threads, but
+    # the proxy site managers built from them must not be.
+
+    def __init__(self):
+        threading.local.__init__(self)
+        self.managers = {}
+
+
+class TraversalProxyStats(object):
+    """
+    Counts of the work :func:`threadSiteSubscriber` did to proxy
+    traversed sites in the current request, that is, since
+    :func:`reset_traversal_proxy_stats` was last called.
+
+    .. versionadded:: 3.2.0
+    """
+
+    __slots__ = (
+        'proxies',
+        'managers_created',
+        'managers_reused',
+        'switches',
+        'switches_skipped',
+    )
+
+    def __init__(self):
+        #: The number of proxy sites installed.
+        self.proxies = 0
+        #: The number of new site managers built for them.
+        self.managers_created = 0
+        #: The number of times an existing site manager was used instead.
+        self.managers_reused = 0
+        #: The number of times the current site was changed. (Sites
+        #: installed other than by :func:`threadSiteSubscriber`, such
+        #: as by a tween, aren't counted.)
+        self.switches = 0
+        #: The number of times changing the current site was skipped because
+        #: the new site was equivalent to the current site.
+        self.switches_skipped = 0
+
+    def __repr__(self):
+        return ("<%s proxies=%d managers_created=%d managers_reused=%d "
+                "switches=%d switches_skipped=%d>") % (
+                    type(self).__name__,
+                    self.proxies, self.managers_created, self.managers_reused,
+                    self.switches, self.switches_skipped
+                )
+
+_traversal_proxy_stats = ContextVar('nti.site.traversal_proxy_stats', default=None)
+
+def get_traversal_proxy_stats():
+    """
+    Return the :class:`TraversalProxyStats` for the current request
+    (thread or context).
+
+    .. versionadded:: 3.2.0
+    """
+    stats = _traversal_proxy_stats.get()
+    if stats is None:
+        stats = TraversalProxyStats()
+        _traversal_proxy_stats.set(stats)
+    return stats
+
+def reset_traversal_proxy_stats():
+    """
+    Start a new :class:`TraversalProxyStats` for the current thread or
+    context, and return the previous one.
+
+    :func:`threadSiteSubscriber` does this when it installs a site and
+    there is no current site. Applications that install the host site
+    before traversal begins (for example, a tween calling
+    :func:`~zope.component.hooks.setSite`) never reach that case, so
+    they must call this at the start of each request to get counts for
+    that request. (Or at the end, to report the counts.)
+
+    .. versionadded:: 3.2.0
+    """
+    previous = get_traversal_proxy_stats()
+    _traversal_proxy_stats.set(TraversalProxyStats())
+    return previous
+
+
+def _canonical_proxy_bases(site_manager, host_components):
+    # We need to keep host_components in the bases
+    # for the new site. Where to put it is tricky
+    # if we want to support multiple layers of overriding
+    # of host registrations. Fortunately, the zope.interface.ro
+    # machinery does exactly the right thing if we tack host
+    # components (which are probably not already in the list)
+    # on to the end. If they are in the list already, they
+    # stay where they were. Duplicates are dropped so that proxying
+    # an already proxied site manager doesn't keep extending the bases.
+    bases = []
+    for base in site_manager.__bases__ + (host_components,):
+        if base not in bases:
+            bases.append(base)
+    return tuple(bases)
+
+
+def _get_proxy_site_manager(new_site, host_components):
+    """
+    Return a site manager for *new_site* that has *host_components*
+    at the end of its resolution order.
+
+    Building one is expensive (setting the bases computes a resolution
+    order and initializes new adapter registries), so they are cached
+    on the traversed site manager, keyed by the host components. A
+    cached site manager is only reused if neither the bases of the
+    traversed site manager nor those of the host components have changed.
+    The cache is kept separately for each thread. For persistent site
+    managers, it is a volatile attribute and goes away when they are
+    ghosted.
+
+    If the site manager of *new_site* is itself a proxy site manager
+    for the same host components, it is used as-is.
+
+    .. versionadded:: 3.2.0
+    """
+    stats = get_traversal_proxy_stats()
+    site_manager = new_site.getSiteManager()
+    new_bases = _canonical_proxy_bases(site_manager, host_components)
+    if new_bases == site_manager.__bases__ \
+       and getattr(site_manager, 'host_components', None) is host_components:
+        stats.managers_reused += 1
+        return site_manager
+
+    shape = (new_bases, host_components.__bases__)
+    cache = getattr(site_manager, _PROXY_CACHE_ATTR, None)
+    if cache is not None:
+        cached_shape, new_site_manager = cache.managers.get(host_components,
+                                                            (None, None))
+        # Don't share registrations made through the cached site
+        # manager with later traversals.
+        if cached_shape == shape and new_site_manager.local_components is None:
+            stats.managers_reused += 1
+            return new_site_manager
+
+    # TODO: We don't need to proxy the site manager, right?
+    # it's almost never special by itself...
+    new_site_manager = LookupSiteManager(new_site.__parent__,
+                                         new_site.__name__,
+                                         new_bases)
+    new_site_manager.host_components = host_components
+    stats.managers_created += 1
+
+    if cache is None:
+        cache = _ProxySiteManagerCache()
+        try:
+            setattr(site_manager, _PROXY_CACHE_ATTR, cache)
+        except AttributeError:
+            # Can't cache on this object (e.g., it's slotted).
+            return new_site_manager
+    cache.managers[host_components] = (shape, new_site_manager)
+    return new_site_manager
+
+
+def _unproxied(site):
+    # pylint:disable-next=unidiomatic-typecheck
+    return getProxiedObject(site) if type(site) is _ProxyTraversedSite else site
+
+
+def _unmemoized(site_manager):
+    # pylint:disable-next=unidiomatic-typecheck
+    if type(site_manager) is MemoizingSiteManager:
+        return site_manager._site_manager
+    return site_manager
+
+
+def _is_current(current_site, new_site, new_site_manager):
+    # Would installing *new_site* with *new_site_manager* change nothing?
+    if _unproxied(current_site) is not _unproxied(new_site):
+        return False
+    return _unmemoized(current_site.getSiteManager()) is new_site_manager
+
+
+def _switch_site(new_site, new_site_manager=None):
+    # Install *new_site*, or, if given *new_site_manager*, a proxy of it
+    # using that site manager.
+    if _memoize_traversal_lookups.get():
+        if new_site_manager is None:
+            new_site_manager = new_site.getSiteManager()
+        # The memo belongs to the installed site, so it's dropped when
+        # the site is replaced or cleared.
+        new_site_manager = MemoizingSiteManager(new_site_manager)
+    if new_site_manager is not None:
+        new_site = _ProxyTraversedSite(new_site, new_site_manager)
+    get_traversal_proxy_stats().switches += 1
+    setSite(new_site)
+
+
+#: Whether traversing from a site to another is ignored depends only on
+#: the interfaces they provide, so it's cached here, keyed by their
+#: ``providedBy`` specifications:
+#: ``{(current spec, new spec): ignored}``. Directly providing an
+#: interface (``alsoProvides``) gives an object a different
+#: specification and hence a different key.
+_ignored_traversals = {}
+
+#: The maximum number of entries in :data:`_ignored_traversals`; it is
+#: emptied when this is reached.
+_MAX_IGNORED_TRAVERSALS = 1000
+
+def _is_ignored_traversal(current_site, new_site):
+    key = (providedBy(current_site), providedBy(new_site))
+    try:
+        return _ignored_traversals[key]
+    except KeyError:
+        pass
+    current_spec, new_spec = key
+
+    # TODO: Since we get these events, we could actually replace
+    # nti.appserver.tweens.zope_site_tween with this. That's
+    # probably the longterm answer.
+    #
+    # The complication with that is that the tween uses information in the Pyramid request
+    # to find ``nti.site.site.get_site_for_site_names`` and install that site
+    # before traversal. The "right" solution to this is probably something to do
+    # with "virtual hosts" and setting the path up to traverse through that site
+    # first, and then into the real traversal?
+    ignored = new_spec.isOrExtends(IMainApplicationFolder) or new_spec.isOrExtends(IRootFolder)
+
+    # Both being host policy folders is typically the case when we traverse directly
+    # into utilities registered with the site, for example
+    #   /dataserver2/++etc++hostsites/janux.ou.edu/++etc++site/SOMEUTILITY/...
+    # with the current host NOT being janux.ou.edu.
+    # We do not want to switch host configurations here, but we do
+    # want to allow traversal, so we take no action.
+    # TODO: We might want to only allow this if there is some
+    # inheritance relationship between the two sites?
+    ignored = ignored or (current_spec.isOrExtends(IHostPolicyFolder)
+                          and new_spec.isOrExtends(IHostPolicyFolder))
+
+    if len(_ignored_traversals) >= _MAX_IGNORED_TRAVERSALS:
+        _ignored_traversals.clear()
+    _ignored_traversals[key] = ignored
+    return ignored
+
+
 @component.adapter(ISite, IBeforeTraverseEvent)
 def threadSiteSubscriber(new_site, _event):
     """
@@ -107,15 +383,45 @@ def threadSiteSubscriber(new_site, _event):
 
         No longer raises a ``LocationError`` if an unknown type of site
         is encountered. Instead, simply installs it, replacing the current site.
+
+    .. versionchanged:: 3.2.0
+
+        Reuse the proxy site managers built when traversing into a site
+        while host components are installed, unless something was
+        registered through them. They are now :class:`~.LookupSiteManager`
+        objects instead of :class:`~.BasedSiteManager`.
+
+        Optionally memoize utility lookups made through the installed
+        site; see :func:`set_memoize_traversal_lookups`.
+
+        Nested proxies are normalized: an already proxied site is
+        unwrapped, and the bases of proxy site managers are
+        deduplicated. The work done is counted; see
+        :func:`get_traversal_proxy_stats`.
+
+        Don't change the site if the new proxy would be equivalent to the
+        current site (the same site with the same site manager).
+
+        Whether to ignore a site based on the interfaces it and the
+        current site provide is decided once per combination of
+        interfaces and cached.
     """
 
+    # Never proxy a proxy; start from the real site.
+    new_site = _unproxied(new_site)
+
     current_site = getSite()
     if current_site is None:
-        # Nothing to do
-        setSite(new_site)
+        # Nothing to do; this is the start of a new request.
+        reset_traversal_proxy_stats()
+        _switch_site(new_site)
         return
 
-    if current_site is new_site:
+    # pylint:disable-next=unidiomatic-typecheck
+    if current_site is new_site or (type(current_site) is _ProxyTraversedSite
+                                    and _is_current(current_site, new_site,
+                                                    new_site.getSiteManager())):
+        # (The second case is a site installed with memoized lookups.)
         # This is typically the case when we traverse directly
         # into utilities registered with the site, for example
         #   /dataserver2/++etc++hostsites/janux.ou.edu/++etc++site/SOMEUTILITY/...
@@ -123,29 +429,7 @@ def threadSiteSubscriber(new_site, _event):
         return
 
 
-    if IMainApplicationFolder.providedBy(new_site) or IRootFolder.providedBy(new_site):
-        # TODO: Since we get these events, we could actually replace
-        # nti.appserver.tweens.zope_site_tween with this. That's
-        # probably the longterm answer.
-        #
-        # The complication with that is that the tween uses information in the Pyramid request
-        # to find ``nti.site.site.get_site_for_site_names`` and install that site
-        # before traversal. The "right" solution to this is probably something to do
-        # with "virtual hosts" and setting the path up to traverse through that site
-        # first, and then into the real traversal?
-        return
-
-    # pylint:disable=no-value-for-parameter
-    if IHostPolicyFolder.providedBy(current_site) and \
-       IHostPolicyFolder.providedBy(new_site):
-        # This is typically the case when we traverse directly
-        # into utilities registered with the site, for example
-        #   /dataserver2/++etc++hostsites/janux.ou.edu/++etc++site/SOMEUTILITY/...
-        # with the current host NOT being janux.ou.edu.
-        # We do not want to switch host configurations here, but we do
-        # want to allow traversal, so we take no action.
-        # TODO: We might want to only allow this if there is some
-        # inheritance relationship between the two sites?
+    if _is_ignored_traversal(current_site, new_site):
         return
 
     if hasattr(current_site.getSiteManager(), 'host_components'):
@@ -154,30 +438,19 @@ def threadSiteSubscriber(new_site, _event):
         # we always want to proxy, putting the preserved host components
         # at the end of the new proxy RO.
         host_components = current_site.getSiteManager().host_components
-        # We need to keep host_components in the bases
-        # for the new site. Where to put it is tricky
-        # if we want to support multiple layers of overriding
-        # of host registrations. Fortunately, the zope.interface.ro
-        # machinery does exactly the right thing if we tack host
-        # components (which are probably not already in the list)
-        # on to the end. If they are in the list already, they
-        # stay where they were.
-        new_bases = new_site.getSiteManager().__bases__ + (host_components,)
-        # TODO: We don't need to proxy the site manager, right?
-        # it's almost never special by itself...
-        new_site_manager = BasedSiteManager(new_site.__parent__,
-                                            new_site.__name__,
-                                            new_bases)
-        new_site_manager.host_components = host_components
-        new_fake_site = _ProxyTraversedSite(new_site,
-                                            new_site_manager)
-
-        setSite(new_fake_site)
+        new_site_manager = _get_proxy_site_manager(new_site, host_components)
+        if _is_current(current_site, new_site, new_site_manager):
+            # We'd install an equivalent proxy; keep the current one,
+            # and its warm adapter hook.
+            get_traversal_proxy_stats().switches_skipped += 1
+            return
+        get_traversal_proxy_stats().proxies += 1
+        _switch_site(new_site, new_site_manager)
         return
 
     # We're out of special cases we understand. Hopefully the
     # application knows what it is doing.
-    setSite(new_site)
+    _switch_site(new_site)
 
 
 @component.adapter(INewLocalSite)
@@ -191,8 +464,21 @@ def new_local_site_dispatcher(event):
     ObjectEvent will be fired for (sitemanager, site-event);
     that is, you subscribe to the site manager and the object moved
     event, but the event will have the ISite as the object property.
+
+    .. versionchanged:: 3.2.0
+       Skip dispatching if no handler is registered for the types of
+       the site manager and event. The adapter registry caches the
+       answer until its registrations change.
     """
-    component.handle(event.manager, event)
+    if _has_new_local_site_handlers(event.manager, event):
+        component.handle(event.manager, event)
+
+
+def _has_new_local_site_handlers(manager, event):
+    registry = component.getSiteManager().adapters
+    # subscriptions is copied onto the registry from its lookup object.
+    # pylint:disable-next=no-member
+    return bool(registry.subscriptions((providedBy(manager), providedBy(event)), None))
 
 
 @component.adapter(IHostPolicyFolder, IObjectRemovedEvent)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import asyncio
+import threading
+from unittest import mock
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_properties
+from hamcrest import less_than_or_equal_to
+from hamcrest import none
+
+from nti.testing import base
+
+import transaction
+
+from zope import component
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+
+from zope.site import SiteManagerContainer
+
+import ZODB.DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.interfaces import IDatabase
+
+from nti.site import asyncrunner
+from nti.site.asyncrunner import AsyncSiteJobRunner
+from nti.site.asyncrunner import run_job_in_site_async
+
+from nti.site.contextsite import install_context_site_storage
+from nti.site.contextsite import uninstall_context_site_storage
+
+from nti.site.interfaces import ISiteTransactionRunner
+from nti.site.interfaces import ITransactionSiteNames
+
+from nti.site.runner import get_site_for_site_names
+from nti.site.runner import run_job_in_site
+
+from nti.site.transient import TrivialSite
+
+
+class TestAsyncRunner(base.AbstractTestBase):
+
+    def setUp(self):
+        super().setUp()
+        db = ZODB.DB(DemoStorage(name='base'), pool_size=3)
+        component.provideUtility(db, IDatabase)
+        component.provideUtility(run_job_in_site, ISiteTransactionRunner)
+
+        conn = db.open()
+        smc = conn.root()['nti.dataserver'] = SiteManagerContainer()
+        smc.setSiteManager(component.getGlobalSiteManager())
+        transaction.commit()
+        conn.close()
+
+    def test_bounded_concurrency(self):
+        runner = AsyncSiteJobRunner()
+        assert_that(runner.max_workers, is_(3))
+        lock = threading.Lock()
+        active = [0, 0] # current, max
+
+        def job(i):
+            def func():
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                threading.Event().wait(0.01)
+                with lock:
+                    active[0] -= 1
+                return i
+            return func
+
+        async def main():
+            return await asyncio.gather(*[runner(job(i)) for i in range(10)])
+
+        try:
+            results = asyncio.run(main())
+        finally:
+            runner.shutdown()
+        assert_that(results, is_(list(range(10))))
+        assert_that(active[1], is_(less_than_or_equal_to(3)))
+        assert_that(runner.stats, has_properties(waiting=0, running=0, completed=10))
+        assert_that(runner.stats.mean_wait_time, is_(runner.stats.total_wait_time / 10))
+        repr(runner.stats)
+
+    def test_site_names_carried(self):
+        local = threading.local()
+
+        def site_names():
+            return getattr(local, 'names', None)
+        component.provideUtility(site_names, ITransactionSiteNames)
+
+        async def main():
+            local.names = ('example.com',)
+            return await run_job_in_site_async(lambda: 42)
+
+        with mock.patch('nti.site.runner.get_site_for_site_names',
+                        wraps=get_site_for_site_names) as get_site:
+            with mock.patch.object(asyncrunner, '_default_runner', None):
+                assert_that(asyncio.run(main()), is_(42))
+                asyncrunner._default_runner.shutdown()
+        assert_that(get_site.call_args[0][0], is_(('example.com',)))
+
+    def test_multiple_event_loops(self):
+        runner = AsyncSiteJobRunner(max_workers=1, runner=run_job_in_site)
+
+        async def main():
+            # More jobs than workers, so some have to wait.
+            return await asyncio.gather(*[runner(lambda i=i: i) for i in range(3)])
+
+        try:
+            assert_that(asyncio.run(main()), is_([0, 1, 2]))
+            assert_that(asyncio.run(main()), is_([0, 1, 2]))
+        finally:
+            runner.shutdown()
+        assert_that(runner.stats, has_properties(waiting=0, running=0, completed=6))
+
+    def test_caller_site_not_carried(self):
+        seen = []
+        def runner(func):
+            seen.append(getSite())
+            return func()
+        async_runner = AsyncSiteJobRunner(max_workers=1, runner=runner)
+
+        async def main():
+            setSite(TrivialSite(component.getGlobalSiteManager()))
+            return await async_runner(getSite)
+
+        install_context_site_storage()
+        try:
+            assert_that(asyncio.run(main()), is_(none()))
+        finally:
+            uninstall_context_site_storage()
+            async_runner.shutdown()
+        assert_that(seen, is_([None]))
+
+    def test_errors_propagate(self):
+        runner = AsyncSiteJobRunner(max_workers=1, runner=run_job_in_site)
+        def func():
+            raise ValueError
+
+        try:
+            with self.assertRaises(ValueError):
+                asyncio.run(runner(func))
+        finally:
+            runner.shutdown()
+        assert_that(runner.stats, has_properties(running=0, completed=1))
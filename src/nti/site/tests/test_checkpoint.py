@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_length
+
+from zope import component
+from zope.component.hooks import getSite
+from zope.component.hooks import site as currentSite
+from zope.interface.interfaces import IComponents
+
+from nti.testing.matchers import verifiably_provides
+
+from nti.site.checkpoint import FileHostSiteJobCheckpoint
+from nti.site.checkpoint import PersistentHostSiteJobCheckpoint
+
+from nti.site.hostpolicy import get_all_host_sites
+from nti.site.hostpolicy import run_job_in_all_host_sites
+from nti.site.hostpolicy import synchronize_host_policies
+
+from nti.site.interfaces import IHostSiteJobCheckpoint
+
+from nti.site.testing import persistent_site_trans as mock_db_trans
+from nti.site.testing import uses_independent_db_site as WithMockDS
+
+from nti.site.tests import SharedConfiguringTestLayer
+from nti.site.tests.test_sync import _SITES
+
+
+class _Boom(Exception):
+    pass
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    #: Set by WithMockDS
+    db = None
+
+    def setUp(self):
+        super().setUp()
+        gsm = component.getGlobalSiteManager()
+        for site in _SITES:
+            # pylint:disable-next=unnecessary-dunder-call
+            site.__init__(site.__parent__, name=site.__name__, bases=site.__bases__)
+            gsm.registerUtility(site, name=site.__name__, provided=IComponents)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        gsm = component.getGlobalSiteManager()
+        for site in _SITES:
+            gsm.unregisterUtility(site, name=site.__name__, provided=IComponents)
+        shutil.rmtree(self.tmpdir)
+        super().tearDown()
+
+    def _check_resume(self, checkpoint_factory):
+        with mock_db_trans():
+            synchronize_host_policies()
+            all_names = [site.__name__ for site in get_all_host_sites()]
+
+        names = []
+        def func():
+            if len(names) == 2:
+                raise _Boom
+            names.append(getSite().__name__)
+            return getSite().__name__
+
+        # In a single transaction, the failure aborts the marks
+        # along with the work.
+        with self.assertRaises(_Boom):
+            with mock_db_trans():
+                checkpoint = checkpoint_factory()
+                assert_that(checkpoint, verifiably_provides(IHostSiteJobCheckpoint))
+                run_job_in_all_host_sites(func, checkpoint=checkpoint)
+        assert_that(names, is_(all_names[:2]))
+
+        # Committing as we go lets us resume.
+        del names[:]
+        conn = self.db.open()
+        try:
+            with currentSite(conn.root()['nti.dataserver']):
+                checkpoint = checkpoint_factory()
+                with self.assertRaises(_Boom):
+                    run_job_in_all_host_sites(func, checkpoint=checkpoint, commit_every=1)
+                transaction.abort()
+        finally:
+            conn.close()
+        assert_that(names, is_(all_names[:2]))
+
+        del names[:]
+        with mock_db_trans():
+            checkpoint = checkpoint_factory()
+            results = run_job_in_all_host_sites(func, checkpoint=checkpoint)
+        assert_that([r for _, r in results], is_(all_names[2:]))
+
+        # Everything is done now
+        with mock_db_trans():
+            checkpoint = checkpoint_factory()
+            assert_that(run_job_in_all_host_sites(func, checkpoint=checkpoint),
+                        has_length(0))
+            checkpoint.clear()
+            checkpoint.clear()
+
+        del names[:]
+        with mock_db_trans():
+            checkpoint = checkpoint_factory()
+            run_job_in_all_host_sites(lambda: None, checkpoint=checkpoint)
+            # Aborted, so nothing is recorded
+            transaction.get().doom()
+
+        with mock_db_trans():
+            checkpoint = checkpoint_factory()
+            assert_that(checkpoint.is_completed(all_names[0]), is_(False))
+
+    @WithMockDS
+    def test_persistent_checkpoint(self):
+        self._check_resume(lambda: PersistentHostSiteJobCheckpoint('job'))
+
+    @WithMockDS
+    def test_file_checkpoint(self):
+        path = os.path.join(self.tmpdir, 'job.txt')
+        self._check_resume(lambda: FileHostSiteJobCheckpoint(path))
+
+        # Clearing discards names waiting for a commit.
+        txm = transaction.TransactionManager()
+        checkpoint = FileHostSiteJobCheckpoint(path, txm)
+        txm.begin()
+        checkpoint.mark_completed('a')
+        checkpoint.clear()
+        txm.commit()
+        assert_that(FileHostSiteJobCheckpoint(path).is_completed('a'), is_(False))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import asyncio
+import threading
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import same_instance
+
+from zope.component import globalSiteManager as BASE
+from zope.component import hooks
+from zope.component.hooks import getSite
+from zope.component.hooks import getSiteManager
+from zope.component.hooks import setSite
+
+from zope.site.site import LocalSiteManager as LSM
+
+from nti.site.contextsite import ContextSiteInfo
+from nti.site.contextsite import install_context_site_storage
+from nti.site.contextsite import is_context_site_storage_installed
+from nti.site.contextsite import uninstall_context_site_storage
+
+from nti.site.transient import TrivialSite
+
+
+class TestContextSite(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.thread_siteinfo = hooks.siteinfo
+
+    def tearDown(self):
+        uninstall_context_site_storage()
+        setSite()
+        super().tearDown()
+
+    def test_install_preserves_site(self):
+        site = TrivialSite(LSM(None))
+        setSite(site)
+        siteinfo = install_context_site_storage()
+        assert_that(siteinfo, is_(ContextSiteInfo))
+        assert_that(is_context_site_storage_installed(), is_(True))
+        assert_that(install_context_site_storage(), is_(same_instance(siteinfo)))
+        assert_that(getSite(), is_(same_instance(site)))
+        assert_that(getSiteManager(), is_(same_instance(site.getSiteManager())))
+
+        other = TrivialSite(LSM(None))
+        setSite(other)
+        uninstall_context_site_storage()
+        assert_that(is_context_site_storage_installed(), is_(False))
+        assert_that(hooks.siteinfo, is_(same_instance(self.thread_siteinfo)))
+        assert_that(getSite(), is_(same_instance(other)))
+        uninstall_context_site_storage()
+
+    def test_adapter_hook(self):
+        install_context_site_storage()
+        siteinfo = hooks.siteinfo
+        with self.assertRaises(AttributeError):
+            del siteinfo.adapter_hook
+        # adapter_hook is copied onto the registry from its lookup object.
+        # pylint:disable-next=no-member
+        assert_that(siteinfo.adapter_hook, is_(BASE.adapters.adapter_hook))
+        del siteinfo.adapter_hook
+
+        site = TrivialSite(LSM(None))
+        setSite(site)
+        assert_that(siteinfo.adapter_hook,
+                    is_(site.getSiteManager().adapters.adapter_hook))
+
+    def test_tasks_have_own_site(self):
+        install_context_site_storage()
+        sites = [TrivialSite(LSM(None)) for _ in range(3)]
+        seen = []
+
+        async def task(site):
+            assert_that(getSite(), is_(none()))
+            setSite(site)
+            await asyncio.sleep(0)
+            seen.append(getSite() is site and getSiteManager() is site.getSiteManager())
+
+        async def main():
+            await asyncio.gather(*[task(site) for site in sites])
+
+        asyncio.run(main())
+        assert_that(seen, is_([True, True, True]))
+        assert_that(getSite(), is_(none()))
+
+    def test_threads_start_without_site(self):
+        install_context_site_storage()
+        setSite(TrivialSite(LSM(None)))
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(getSite()))
+        thread.start()
+        thread.join()
+        assert_that(seen, is_([None]))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import contains_string
+from hamcrest import has_properties
+
+from zope.interface.verify import verifyObject
+
+from nti.site.interfaces import IJobMetricsSink
+from nti.site.metrics import InMemoryJobMetrics
+
+
+class TestInMemoryJobMetrics(unittest.TestCase):
+
+    def test_provides(self):
+        verifyObject(IJobMetricsSink, InMemoryJobMetrics())
+
+    def test_totals(self):
+        metrics = InMemoryJobMetrics()
+        metrics.record_job('job', 'site', True, 2, {'ConflictError': 1}, 0.5, 0.25, 1.0)
+        metrics.record_job('job', 'site', False, 1, {}, 0.5, 0.0, 2.0,
+                           prefetched=3, loaded=4)
+        stats = metrics.get('job', 'site')
+        assert_that(stats, has_properties(jobs=2, failures=1, attempts=3,
+                                          conflicts={'ConflictError': 1},
+                                          handler_time=1.0, commit_time=0.25,
+                                          total_time=3.0, max_total_time=2.0,
+                                          prefetched=3, loaded=4))
+        repr(stats)
+        metrics.reset()
+        assert_that(metrics.get('job', 'site'), is_(none()))
+
+    def test_to_prometheus(self):
+        metrics = InMemoryJobMetrics()
+        metrics.record_job('job', 'a "quoted"\\site', True, 2, {'ConflictError': 1},
+                           0.5, 0.25, 1.0)
+        text = metrics.to_prometheus()
+        assert_that(text, contains_string('# TYPE nti_site_job_runs_total counter\n'))
+        assert_that(text, contains_string(
+            'nti_site_job_runs_total{job="job",site="a \\"quoted\\"\\\\site"} 1\n'))
+        assert_that(text, contains_string(
+            'nti_site_job_conflicts_total{job="job",site="a \\"quoted\\"\\\\site",'
+            'type="ConflictError"} 1\n'))
+        assert_that(text, contains_string(
+            'nti_site_job_latency_seconds_max{job="job",site="a \\"quoted\\"\\\\site"} 1.0\n'))
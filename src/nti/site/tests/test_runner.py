@@ -13,7 +13,17 @@ logger = __import__('logging').getLogger(__name__)
 
 from hamcrest import assert_that
 from hamcrest import is_
-
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import same_instance
+from hamcrest import has_properties
+from hamcrest import greater_than
+from hamcrest import contains_inanyorder
+from hamcrest import contains_string
+from hamcrest import less_than_or_equal_to
+
+import threading
+from unittest import mock
 
 from nti.testing import base
 
@@ -21,20 +31,65 @@ import six
 import transaction
 
 from zope import component
+from zope.component.hooks import getSite
+from zope.component.hooks import setHooks
+from zope.component.hooks import setSite
+from zope.interface import Interface
 from ZODB.interfaces import IDatabase
 
 import ZODB.DB
+from ZODB.POSException import ConflictError
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
+from ZODB.Connection import Connection
 from ZODB.DemoStorage import DemoStorage
+from zope.site import LocalSiteManager
 from zope.site import SiteManagerContainer
+from zope.interface.interfaces import IComponents
+
+from z3c.baseregistry.baseregistry import BaseComponents
+
+from nti.transactions.interfaces import IWillSleepBetweenAttempts
 
 
 from ..runner import run_job_in_site
 from ..runner import _tx_string
+from ..runner import WarmConnectionCache
+from ..runner import run_jobs_in_site
+from ..runner import run_job_in_sites
+from ..runner import AdaptiveRetryPolicy
+from ..runner import check_job_deadline
+
+from ..contextsite import install_context_site_storage
+from ..contextsite import uninstall_context_site_storage
 
 from ..transient import TrivialSite
 
+from ..interfaces import IJobMetricsSink
+from ..interfaces import JobTimeoutError
+from ..interfaces import ReadOnlyJobError
+from ..interfaces import SiteNotFoundError
 from ..interfaces import SiteNotInstalledError
 
+from ..metrics import InMemoryJobMetrics
+
+from ..site import get_site_for_site_names
+
+
+class PersistentSiteManagerContainer(Persistent, SiteManagerContainer):
+    pass
+
+
+class IPrefetched(Interface): # pylint:disable=inherit-non-class
+    pass
+
+
+def _register_site_components(*site_names):
+    gsm = component.getGlobalSiteManager()
+    for site_name in site_names:
+        gsm.registerUtility(BaseComponents(gsm, site_name, (gsm,)), IComponents,
+                            name=site_name)
+
 
 class TestRunner(base.AbstractTestBase):
 
@@ -139,3 +194,417 @@ class TestRunner(base.AbstractTestBase):
 
 
         run_job_in_site(Callable())
+
+    def _install_persistent_site(self):
+        setHooks()
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        smc = conn.root()['nti.dataserver'] = PersistentSiteManagerContainer()
+        smc.setSiteManager(LocalSiteManager(smc))
+        transaction.commit()
+        conn.close()
+        return db
+
+    def test_site_resolved_once(self):
+        self._install_persistent_site()
+        sites = []
+        def func():
+            sites.append(getSite())
+            if len(sites) < 3:
+                raise ConflictError
+            return getSite()._p_oid
+
+        with mock.patch('nti.site.runner.get_site_for_site_names',
+                        wraps=get_site_for_site_names) as get_site:
+            result = run_job_in_site(func, retries=2, sleep=0)
+        assert_that(get_site.call_count, is_(1))
+        assert_that(sites, has_length(3))
+        assert_that(result, is_(sites[0]._p_oid))
+        assert_that(sites[2], is_(same_instance(sites[0])))
+
+        # Sites that aren't committed are resolved each time.
+        del sites[:]
+        with mock.patch('nti.site.runner.get_site_for_site_names') as get_site:
+            get_site.return_value = PersistentSiteManagerContainer()
+            get_site.return_value.setSiteManager(component.getGlobalSiteManager())
+            run_job_in_site(func, retries=2, sleep=0)
+        assert_that(get_site.call_count, is_(3))
+
+    def test_warm_connection_cache(self):
+        cache = WarmConnectionCache(max_jobs=3)
+        counters = []
+        def func():
+            conn = getSite()._p_jar
+            conn.root()['counter'] = conn.root().get('counter', 0) + 1
+            counters.append(conn.root()['counter'])
+
+        # Use a persistent site so we can find the connection
+        db = self._install_persistent_site()
+
+        with mock.patch.object(db, 'open', wraps=db.open) as db_open:
+            for _ in range(4):
+                run_job_in_site(func, connection_cache=cache)
+            # The first three used the same connection; it was then closed.
+            assert_that(db_open.call_count, is_(2))
+            assert_that(cache.jobs, is_(1))
+            warm = cache.connection
+
+            # Changes made elsewhere are seen at the next begin.
+            conn = db.open()
+            conn.root()['counter'] = 42
+            transaction.commit()
+            conn.close()
+            run_job_in_site(func, connection_cache=cache)
+            assert_that(db_open.call_count, is_(3))
+            assert_that(cache.connection, is_(same_instance(warm)))
+            assert_that(counters, is_([1, 2, 3, 4, 43]))
+
+            # Idle connections are replaced.
+            cache.max_idle = -1
+            run_job_in_site(func, connection_cache=cache)
+            assert_that(db_open.call_count, is_(4))
+
+        # Other threads get their own connection
+        other = []
+        thread = threading.Thread(target=lambda: other.append(cache.connection))
+        thread.start()
+        thread.join()
+        assert_that(other, is_([None]))
+
+        warm = cache.connection
+        cache.close()
+        assert_that(warm.opened, is_(none()))
+        assert_that(cache.connection, is_(none()))
+        cache.close()
+
+    def test_run_jobs_in_site_data_manager_retryable(self):
+        self._install_persistent_site()
+        attempts = []
+
+        class Retryable(Exception):
+            pass
+
+        class DataManager(object):
+            transaction_manager = None
+            def abort(self, tx):
+                pass
+            def sortKey(self):
+                return 'DataManager'
+            def should_retry(self, error):
+                return isinstance(error, Retryable)
+
+        def job(key, error=None):
+            def func():
+                attempts.append(key)
+                if error is not None:
+                    txm = transaction.manager
+                    data_manager = DataManager()
+                    data_manager.transaction_manager = txm
+                    txm.get().join(data_manager)
+                    raise error
+                return key
+            return func
+
+        # The data manager says its error can be retried, so the batch
+        # is retried and then split, just like for a ConflictError.
+        funcs = [job('a'), job('b', Retryable())]
+        results = run_jobs_in_site(funcs, retries=1)
+        assert_that([r.succeeded for r in results], is_([True, False]))
+        assert_that(results[1].exception, is_(Retryable))
+        assert_that(''.join(attempts), is_(''.join(['ab', 'ab', 'a', 'b', 'b'])))
+
+    def test_run_jobs_in_site(self):
+        db = self._install_persistent_site()
+        attempts = []
+
+        def job(key, error=None):
+            def func():
+                attempts.append(key)
+                getSite()._p_jar.root()[key] = True
+                if error is not None:
+                    raise error
+                return key
+            return func
+
+        funcs = [job('a'), job('b', ValueError()), job('c'), job('d', ConflictError()), job('e')]
+        results = run_jobs_in_site(funcs, job_name='batch')
+        assert_that([r.func for r in results], is_(funcs))
+        assert_that([r.succeeded for r in results], is_([True, False, True, False, True]))
+        assert_that([r.result for r in results], is_(['a', None, 'c', None, 'e']))
+        assert_that(results[1].exception, is_(ValueError))
+        assert_that(results[3].exception, is_(ConflictError))
+        repr(results[0])
+        # The whole batch (stopping at the conflict), then [a, b] and
+        # [c, d, e], then [c] and [d, e], then [d] and [e].
+        assert_that(''.join(attempts), is_(''.join(['abcd', 'ab', 'cd', 'c', 'd', 'd', 'e'])))
+
+        conn = db.open()
+        try:
+            root = conn.root()
+            assert_that(sorted(k for k in 'abcde' if k in root), is_(['a', 'c', 'e']))
+        finally:
+            conn.close()
+
+        assert_that(run_jobs_in_site(()), is_([]))
+
+    def test_job_metrics(self):
+        self._install_persistent_site()
+        metrics = InMemoryJobMetrics()
+        component.provideUtility(metrics, IJobMetricsSink)
+        calls = []
+        def func():
+            calls.append(1)
+            getSite()._p_jar.root()['key'] = len(calls)
+            if len(calls) < 3:
+                raise ConflictError
+            if len(calls) > 3:
+                raise ValueError
+            return 42
+
+        assert_that(run_job_in_site(func, retries=2, sleep=0), is_(42))
+        with self.assertRaises(ValueError):
+            run_job_in_site(func, job_name='failing')
+
+        stats = metrics.get('func', 'nti.dataserver')
+        assert_that(stats, has_properties(jobs=1, failures=0, attempts=3,
+                                          conflicts={'ConflictError': 2}))
+        assert_that(stats.commit_time, is_(greater_than(0)))
+        assert_that(stats.total_time, is_(greater_than(stats.handler_time)))
+        assert_that(metrics.get('failing', 'nti.dataserver'),
+                    has_properties(jobs=1, failures=1, attempts=1, conflicts={}))
+
+        # Errors in the sink don't fail the job.
+        with mock.patch.object(metrics, 'record_job', side_effect=TypeError):
+            assert_that(run_job_in_site(lambda: 1), is_(1))
+
+    def test_read_only(self):
+        db = self._install_persistent_site()
+        conn = db.open()
+        conn.root()['key'] = 1
+        transaction.commit()
+        tid = db.lastTransaction()
+        conn.root()['key'] = 2
+        transaction.commit()
+        conn.close()
+
+        def read():
+            """A docstring"""
+            assert_that(transaction.get().description, is_(''))
+            return getSite()._p_jar.root()['key']
+
+        def write():
+            getSite()._p_jar.root()['key'] = 3
+
+        assert_that(run_job_in_site(read, read_only=True), is_(2))
+        assert_that(run_job_in_site(read, at=tid), is_(1))
+
+        with self.assertRaises(ReadOnlyJobError):
+            run_job_in_site(write, read_only=True)
+        with self.assertRaises(ReadOnlyJobError):
+            run_job_in_site(write, at=tid)
+        assert_that(run_job_in_site(read, read_only=True), is_(2))
+
+        with self.assertRaises(TypeError):
+            run_job_in_site(read, at=tid, connection_cache=WarmConnectionCache())
+
+    def test_prefetch(self):
+        db = self._install_persistent_site()
+        conn = db.open()
+        root = conn.root()
+        root['a'] = PersistentMapping()
+        b = root['a']['b'] = PersistentMapping()
+        utility = PersistentMapping()
+        sm = root['nti.dataserver'].getSiteManager()
+        sm.registerUtility(utility, IPrefetched)
+        other = root['other'] = PersistentMapping()
+        transaction.commit()
+        # Objects are only looked inside of once they have been
+        # prefetched, so the nested ones take a second round.
+        expected = [[sm.adapters._p_oid, sm.utilities._p_oid, root['a']._p_oid,
+                     other._p_oid],
+                    [b._p_oid, utility._p_oid]]
+        # Only ghosts are prefetched.
+        conn.cacheMinimize()
+        conn.close()
+
+        def func():
+            assert_that(component.getUtility(IPrefetched), is_({}))
+            return 42
+
+        metrics = InMemoryJobMetrics()
+        component.provideUtility(metrics, IJobMetricsSink)
+        with mock.patch.object(Connection, 'prefetch') as prefetch:
+            with self.assertLogs('nti.site.runner', 'DEBUG') as logs:
+                assert_that(run_job_in_site(func,
+                                            prefetch=['a/b', '/missing/x', 'a/b/c/d',
+                                                      IPrefetched, other._p_oid]),
+                            is_(42))
+        assert_that(logs.output[0], contains_string('prefetched 6 objects and then loaded 1'))
+        assert_that(prefetch.call_count, is_(2))
+        for call, oids in zip(prefetch.call_args_list, expected):
+            assert_that(call[0][0], contains_inanyorder(*oids))
+        # The prefetch itself is mocked, so the utility is loaded by func.
+        assert_that(metrics.get('func', 'nti.dataserver'),
+                    has_properties(prefetched=6, loaded=1))
+
+    def test_run_job_in_sites(self):
+        def get_site(site_names, _root):
+            site = TrivialSite(component.getGlobalSiteManager())
+            site.__name__ = site_names[0]
+            return site
+
+        lock = threading.Lock()
+        active = [0, 0] # current, max
+        threads = set()
+        def func():
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+                threads.add(threading.current_thread())
+            threading.Event().wait(0.01)
+            with lock:
+                active[0] -= 1
+            name = getSite().__name__
+            if name == 'bad':
+                raise ValueError(name)
+            return name
+
+        names = ['a', 'b', 'bad', 'c', 'd', 'e']
+        _register_site_components(*names)
+        with mock.patch('nti.site.runner.get_site_for_site_names', side_effect=get_site):
+            results = run_job_in_sites(func, names, max_workers=2, retries=1)
+
+        assert_that(sorted(results), is_(sorted(names)))
+        for name in names:
+            if name == 'bad':
+                assert_that(results[name].exception, is_(ValueError))
+            else:
+                assert_that(results[name].result, is_(name))
+        assert_that(active[1], is_(less_than_or_equal_to(2)))
+        assert_that(len(threads), is_(less_than_or_equal_to(2)))
+        assert_that(threading.current_thread() in threads, is_(False))
+
+        assert_that(run_job_in_sites(func, ()), is_({}))
+
+    def test_run_job_in_sites_unknown_site(self):
+        self._install_persistent_site()
+        _register_site_components('known.example.com')
+        def func():
+            return getSite().__name__
+
+        results = run_job_in_sites(func, ['no-such-tenant.example.com', 'known.example.com'])
+        assert_that(list(results), is_(['no-such-tenant.example.com', 'known.example.com']))
+        assert_that(results['known.example.com'].result, is_('known.example.com'))
+        unknown = results['no-such-tenant.example.com']
+        assert_that(unknown.succeeded, is_(False))
+        assert_that(unknown.exception, is_(SiteNotFoundError))
+
+        results = run_job_in_sites(func, ['no-such-tenant.example.com'])
+        assert_that(results['no-such-tenant.example.com'].exception, is_(SiteNotFoundError))
+
+    def test_run_job_in_sites_caller_site_not_carried(self):
+        _register_site_components('a')
+        install_context_site_storage()
+        try:
+            setSite(TrivialSite(component.getGlobalSiteManager()))
+            with mock.patch('nti.site.runner.run_job_in_site',
+                            side_effect=lambda func, **kwargs: func()):
+                results = run_job_in_sites(getSite, ['a'])
+        finally:
+            setSite(None)
+            uninstall_context_site_storage()
+        assert_that(results['a'].result, is_(none()))
+
+    def test_adaptive_retry_policy(self):
+        policy = AdaptiveRetryPolicy(base=0.1, maximum=1.0, contention_factor=4.0,
+                                     smoothing=0.5)
+        policy.random = mock.Mock(uniform=lambda low, high: high)
+        assert_that(policy.conflict_rate('site'), is_(0.0))
+        assert_that(policy.delay('site', 1), is_(0.1))
+        assert_that(policy.delay('site', 3), is_(0.4))
+        assert_that(policy.delay('site', 10), is_(1.0))
+
+        policy.record_attempt('site', True)
+        assert_that(policy.conflict_rate('site'), is_(0.5))
+        assert_that(policy.delay('site', 1), is_(0.1 * 3))
+        assert_that(policy.delay('other', 1), is_(0.1))
+        policy.record_attempt('site', False)
+        assert_that(policy.conflict_rate('site'), is_(0.25))
+
+    def test_run_with_retry_policy(self):
+        self._install_persistent_site()
+        policy = AdaptiveRetryPolicy(smoothing=0.5)
+        calls = []
+        def func():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConflictError
+            return 42
+
+        with mock.patch('nti.site.runner.time.sleep') as sleep:
+            with mock.patch.object(policy, 'delay', wraps=policy.delay) as delay:
+                result = run_job_in_site(func, retries=2, retry_policy=policy)
+        assert_that(result, is_(42))
+        assert_that(sleep.call_count, is_(2))
+        assert_that([c[0] for c in delay.call_args_list],
+                    is_([('nti.dataserver', 1), ('nti.dataserver', 2)]))
+        # Two conflicts and a success
+        assert_that(policy.conflict_rate('nti.dataserver'), is_(0.375))
+
+    def test_retry_policy_sleep_can_be_changed(self):
+        # Subscribers to WillSleepBetweenAttempts see the policy's delay,
+        # and the loop sleeps for what they leave.
+        self._install_persistent_site()
+        policy = AdaptiveRetryPolicy()
+        seen = []
+        def will_sleep(event):
+            seen.append(event.sleep_time)
+            event.sleep_time = 42
+        component.provideHandler(will_sleep, (IWillSleepBetweenAttempts,))
+
+        calls = []
+        def func():
+            calls.append(1)
+            if len(calls) < 2:
+                raise ConflictError
+            return len(calls)
+
+        with mock.patch('nti.site.runner.time.sleep') as sleep:
+            with mock.patch.object(policy, 'delay', return_value=0.5):
+                assert_that(run_job_in_site(func, retries=2, retry_policy=policy), is_(2))
+        assert_that(seen, is_([0.5]))
+        sleep.assert_called_once_with(42)
+
+    def test_deadline(self):
+        self._install_persistent_site()
+        now = [0.0]
+        calls = []
+        def func():
+            calls.append(1)
+            check_job_deadline()
+            now[0] += 2
+            raise ConflictError
+
+        with mock.patch('nti.site.runner.time.monotonic', side_effect=lambda: now[0]):
+            with mock.patch('nti.site.runner.time.sleep') as sleep:
+                with self.assertRaises(JobTimeoutError):
+                    run_job_in_site(func, retries=10, sleep=100, deadline=5)
+        # Attempts at 0, 2 and 4; the third attempt's sleep is cut
+        # short, and the fourth attempt doesn't start.
+        assert_that(calls, has_length(3))
+        assert_that(sleep.call_args_list[-1][0][0], is_(0))
+        assert_that(sleep.call_args_list[0][0][0], is_(less_than_or_equal_to(3)))
+
+        # Handlers can check it cooperatively.
+        def loop():
+            while True:
+                now[0] += 1
+                check_job_deadline()
+
+        with mock.patch('nti.site.runner.time.monotonic', side_effect=lambda: now[0]):
+            with self.assertRaises(JobTimeoutError):
+                run_job_in_site(loop, retries=10, deadline=5)
+
+        # Outside a job, or without a deadline, it does nothing.
+        check_job_deadline()
+        run_job_in_site(check_job_deadline)
@@ -20,6 +20,7 @@ from hamcrest import not_none
 from hamcrest import has_length
 does_not = is_not
 
+import threading
 import unittest
 from unittest import mock as fudge
 
@@ -29,6 +30,7 @@ from zope.interface import ro
 from zope.interface import implementedBy
 from zope.interface import Interface
 from zope.interface.interfaces import ComponentLookupError
+from zope.interface.registry import Components
 
 from zope.component.hooks import getSite
 from zope.component.hooks import setSite
@@ -51,6 +53,7 @@ from nti.site.site import get_site_for_site_names
 from nti.site.site import find_site_components
 from nti.site.site import get_component_hierarchy
 from nti.site.site import get_component_hierarchy_names
+from nti.site.site import coalesced_registry_changes
 
 from nti.site.tests import SharedConfiguringTestLayer
 
@@ -175,6 +178,26 @@ class TestSiteSubscriber(unittest.TestCase):
         site_folder[key] = new_site
         del site_folder[key]
 
+    def test_proxy_site_manager_registrations_not_shared(self):
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_site = MockSite(HSM('example.com', 'siteman', host_comps, pers_comps))
+        new_site = MockSite(BaseComponents(BASE, 'sub_site', (pers_comps,)))
+        new_site.__name__ = 'sub_site'
+
+        with currentSite(host_site):
+            threadSiteSubscriber(new_site, None)
+            site_manager = getSite().getSiteManager()
+            util = object()
+            site_manager.registerUtility(util, IFoo)
+            assert_that(site_manager.getUtility(IFoo), is_(same_instance(util)))
+
+        # Traversing again doesn't reuse that site manager.
+        with currentSite(host_site):
+            threadSiteSubscriber(new_site, None)
+            assert_that(getSite().getSiteManager(), is_not(same_instance(site_manager)))
+            assert_that(getSite().getSiteManager().queryUtility(IFoo), is_(none()))
+
 
 class TestGetSiteForSiteNames(AbstractTestBase):
 
@@ -660,6 +683,40 @@ class TestPermissiveOOBTree(unittest.TestCase):
         assert_that(tree.get(key), is_(none()))
 
 
+class TestCoalescedRegistryChanges(unittest.TestCase):
+
+    def test_shared_registry(self):
+        components = Components()
+        utilities = components.utilities
+        generation = utilities._generation
+
+        with coalesced_registry_changes(utilities):
+            with coalesced_registry_changes(utilities):
+                components.registerUtility(IFoo, IMock, name='a')
+            components.registerUtility(IFoo, IMock, name='b')
+            assert_that(utilities._generation, is_(generation))
+
+            # Other threads wait to coalesce changes.
+            entered = []
+            def other():
+                with coalesced_registry_changes(utilities):
+                    entered.append(1)
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join(0.05)
+            assert_that(entered, is_([]))
+        thread.join()
+        assert_that(entered, is_([1]))
+        assert_that(utilities._generation, is_(generation + 1))
+        assert_that('changed' in utilities.__dict__, is_(False))
+        assert_that(components.getUtility(IMock, name='b'), is_(same_instance(IFoo)))
+
+        # Nothing changed, nothing invalidated.
+        with coalesced_registry_changes(utilities):
+            pass
+        assert_that(utilities._generation, is_(generation + 1))
+
+
 from zope.interface.tests.test_adapter import CustomTypesBaseAdapterRegistryTests
 
 class BTreeLocalAdapterRegistryCustomTypesTest(CustomTypesBaseAdapterRegistryTests):
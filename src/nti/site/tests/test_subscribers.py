@@ -12,33 +12,61 @@ from hamcrest import raises
 from hamcrest import calling
 from hamcrest import assert_that
 from hamcrest import same_instance
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import none
 does_not = is_not
 
+import threading
 from unittest import mock as fudge
 
+from zope import component
+
+from zope import interface
+
+from zope.interface import Interface
+from zope.interface import providedBy
 from zope.interface import implementer
+from zope.interface.interfaces import ComponentLookupError
+from zope.interface.interfaces import IInterface
 
 from zope.component import globalSiteManager as BASE
 
+from zope.component import hooks
 from zope.component.hooks import getSite
+from zope.component.hooks import setHooks
 from zope.component.hooks import setSite
 
+from zope.proxy import getProxiedObject
+
 from zope.site.site import LocalSiteManager as LSM
 
 from z3c.baseregistry.baseregistry import BaseComponents
 
+from zope.site.interfaces import ILocalSiteManager
+from zope.site.interfaces import INewLocalSite
 from zope.site.interfaces import IRootFolder
+from zope.site.interfaces import NewLocalSite
 
 from nti.site.interfaces import IMainApplicationFolder
 
+from nti.site.subscribers import get_traversal_proxy_stats
+from nti.site.subscribers import reset_traversal_proxy_stats
+from nti.site.subscribers import set_memoize_traversal_lookups
+from nti.site.subscribers import new_local_site_dispatcher
 from nti.site.subscribers import threadSiteSubscriber
 
 from nti.site.transient import HostSiteManager as HSM
+from nti.site.transient import MemoizingSiteManager
 from nti.site.transient import TrivialSite
 
 from nti.testing.base import AbstractTestBase
 
 
+class IFoo(Interface): # pylint:disable=inherit-non-class
+    pass
+
+
 class TestSubscriber(AbstractTestBase):
 
     def _check_site(self, new_site, expected_after_subscriber):
@@ -108,3 +136,292 @@ class TestSubscriber(AbstractTestBase):
         # and it's proxied and we can't change it
         assert_that(calling(getSite().setSiteManager).with_args(None),
                     raises(ValueError, "Cannot set site manager on proxy"))
+
+    def test_proxy_site_managers_cached(self):
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        host_site = TrivialSite(HSM('example.com', 'siteman', host_comps, pers_comps))
+
+        new_comps = BaseComponents(BASE, 'sub_site', (pers_comps,))
+        new_site = TrivialSite(new_comps)
+
+        def traverse():
+            setSite(host_site)
+            threadSiteSubscriber(new_site, None)
+            return getSite().getSiteManager()
+
+        first = traverse()
+        assert_that(first.host_components, is_(same_instance(host_comps)))
+        assert_that(first.__bases__, is_((pers_comps, host_comps)))
+        # Reused when we traverse again...
+        assert_that(traverse(), is_(same_instance(first)))
+
+        # ... but not if the bases of the traversed site change...
+        new_comps.__bases__ = (pers_comps, BASE)
+        second = traverse()
+        assert_that(second, is_not(same_instance(first)))
+        assert_that(second.__bases__, is_((pers_comps, BASE, host_comps)))
+        assert_that(traverse(), is_(same_instance(second)))
+
+        # ... or if the host components change.
+        host_comps.__bases__ = (pers_comps,)
+        third = traverse()
+        assert_that(third, is_not(same_instance(second)))
+        assert_that(traverse(), is_(same_instance(third)))
+
+        # Different host components get their own.
+        host_comps2 = BaseComponents(BASE, 'other.com', (BASE,))
+        setSite(TrivialSite(HSM('other.com', 'siteman', host_comps2, pers_comps)))
+        threadSiteSubscriber(new_site, None)
+        assert_that(getSite().getSiteManager().host_components,
+                    is_(same_instance(host_comps2)))
+        assert_that(traverse(), is_(same_instance(third)))
+
+        # Other threads don't share them.
+        in_thread = []
+        thread = threading.Thread(target=lambda: in_thread.append(traverse()))
+        thread.start()
+        thread.join()
+        assert_that(in_thread[0], is_not(same_instance(third)))
+        assert_that(in_thread[0].__bases__, is_(third.__bases__))
+        assert_that(traverse(), is_(same_instance(third)))
+
+    def test_memoized_lookups(self):
+        assert_that(set_memoize_traversal_lookups(True), is_(False))
+        try:
+            self._check_memoized_lookups()
+        finally:
+            assert_that(set_memoize_traversal_lookups(False), is_(True))
+            setSite()
+
+        # Off again
+        setSite(None)
+        site = TrivialSite(BaseComponents(BASE, 'plain', (BASE,)))
+        threadSiteSubscriber(site, None)
+        assert_that(getSite(), is_(same_instance(site)))
+        setSite()
+
+    def _check_memoized_lookups(self):
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        host_site = TrivialSite(HSM('example.com', 'siteman', host_comps, pers_comps))
+        new_site = TrivialSite(BaseComponents(BASE, 'sub_site', (pers_comps,)))
+
+        util = IFoo
+        pers_comps.registerUtility(util, IInterface, name='foo')
+
+        setSite(host_site)
+        threadSiteSubscriber(new_site, None)
+        site_manager = getSite().getSiteManager()
+        assert_that(site_manager, is_(MemoizingSiteManager))
+        assert_that(site_manager.host_components, is_(same_instance(host_comps)))
+
+        assert_that(site_manager.getUtility(IInterface, 'foo'), is_(same_instance(util)))
+        assert_that(site_manager.queryUtility(IInterface, 'bar', self), is_(same_instance(self)))
+        assert_that(calling(site_manager.getUtility).with_args(IInterface, 'bar'),
+                    raises(ComponentLookupError))
+
+        # Later registrations aren't seen through this site...
+        pers_comps.registerUtility(IInterface, IInterface, name='foo')
+        pers_comps.registerUtility(IInterface, IInterface, name='bar')
+        assert_that(site_manager.getUtility(IInterface, 'foo'), is_(same_instance(util)))
+        assert_that(site_manager.queryUtility(IInterface, 'bar'), is_(none()))
+
+        # ...but are when the site is installed again.
+        setSite(host_site)
+        threadSiteSubscriber(new_site, None)
+        site_manager = getSite().getSiteManager()
+        assert_that(site_manager.getUtility(IInterface, 'foo'), is_(same_instance(IInterface)))
+        assert_that(site_manager.getUtility(IInterface, 'bar'), is_(same_instance(IInterface)))
+
+        # Sites installed without host components are memoized too.
+        setSite(None)
+        plain_comps = BaseComponents(BASE, 'plain', (pers_comps,))
+        plain_site = TrivialSite(plain_comps)
+        threadSiteSubscriber(plain_site, None)
+        memo_site = getSite()
+        assert_that(getProxiedObject(memo_site), is_(same_instance(plain_site)))
+        site_manager = memo_site.getSiteManager()
+        assert_that(site_manager, is_(MemoizingSiteManager))
+        assert_that(site_manager._site_manager, is_(same_instance(plain_comps)))
+        assert_that(site_manager.getUtility(IInterface, 'bar'), is_(same_instance(IInterface)))
+        # Traversing it again keeps the memo.
+        threadSiteSubscriber(plain_site, None)
+        assert_that(getSite(), is_(same_instance(memo_site)))
+
+        # As are other sites traversed into.
+        other_site = TrivialSite(BaseComponents(BASE, 'other', (BASE,)))
+        threadSiteSubscriber(other_site, None)
+        assert_that(getProxiedObject(getSite()), is_(same_instance(other_site)))
+        assert_that(getSite().getSiteManager(), is_(MemoizingSiteManager))
+
+    def test_new_local_site_dispatch_skipped_without_handlers(self):
+        setHooks()
+        site_manager = LSM(None)
+        setSite(TrivialSite(site_manager))
+        event = NewLocalSite(LSM(None))
+        with fudge.patch('nti.site.subscribers.component.handle') as fake_handle:
+            new_local_site_dispatcher(event)
+            new_local_site_dispatcher(event)
+            fake_handle.assert_not_called()
+
+            # Registering a handler is noticed
+            handled = []
+            @component.adapter(ILocalSiteManager, INewLocalSite)
+            def handler(manager, event):
+                handled.append((manager, event))
+            site_manager.registerHandler(handler)
+            new_local_site_dispatcher(event)
+            fake_handle.assert_called_once_with(event.manager, event)
+
+            # As is removing it
+            site_manager.unregisterHandler(handler)
+            new_local_site_dispatcher(event)
+            fake_handle.assert_called_once_with(event.manager, event)
+
+        site_manager.registerHandler(handler)
+        new_local_site_dispatcher(event)
+        assert_that(handled, is_([(event.manager, event)]))
+        setSite()
+
+    def test_nested_proxies_normalized(self):
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        host_site = TrivialSite(HSM('example.com', 'siteman', host_comps, pers_comps))
+        new_comps = BaseComponents(BASE, 'sub_site', (pers_comps,))
+        new_site = TrivialSite(new_comps)
+
+        setSite(None)
+        threadSiteSubscriber(host_site, None)
+        threadSiteSubscriber(new_site, None)
+        proxy = getSite()
+        proxy_sm = proxy.getSiteManager()
+        assert_that(proxy_sm.__bases__, is_((pers_comps, host_comps)))
+
+        # Traversing into a site that already has the host components
+        # in its bases uses its site manager as-is...
+        threadSiteSubscriber(TrivialSite(proxy_sm), None)
+        assert_that(getSite().getSiteManager(), is_(same_instance(proxy_sm)))
+        # ...as does traversing a site whose manager is a host site manager.
+        threadSiteSubscriber(TrivialSite(host_site.getSiteManager()), None)
+        assert_that(getSite().getSiteManager(),
+                    is_(same_instance(host_site.getSiteManager())))
+
+        # Proxies are never proxied again
+        threadSiteSubscriber(proxy, None)
+        assert_that(getSite(), is_not(same_instance(proxy)))
+        assert_that(getProxiedObject(getSite()), is_(same_instance(new_site)))
+        assert_that(getSite().getSiteManager(), is_(same_instance(proxy_sm)))
+        assert_that(getSite().getSiteManager().__bases__, is_((pers_comps, host_comps)))
+
+        stats = get_traversal_proxy_stats()
+        assert_that(stats, has_properties(proxies=4,
+                                          managers_created=1,
+                                          managers_reused=3))
+        repr(stats)
+
+        # Which starts over with each request
+        setSite(None)
+        threadSiteSubscriber(host_site, None)
+        assert_that(get_traversal_proxy_stats(), has_properties(proxies=0))
+        setSite()
+
+    def test_proxy_stats_per_request_with_tween(self):
+        # A tween installs the host site before traversal, so the
+        # subscriber never sees the start of the request.
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        host_site = TrivialSite(HSM('example.com', 'siteman', host_comps, pers_comps))
+        new_site = TrivialSite(BaseComponents(BASE, 'sub_site', (pers_comps,)))
+
+        def request():
+            reset_traversal_proxy_stats()
+            setSite(host_site)
+            try:
+                threadSiteSubscriber(new_site, None)
+                return get_traversal_proxy_stats()
+            finally:
+                setSite()
+
+        for _ in range(3):
+            assert_that(request(), has_properties(proxies=1))
+
+        # The counts for the last request are returned.
+        stats = get_traversal_proxy_stats()
+        assert_that(reset_traversal_proxy_stats(), is_(same_instance(stats)))
+        assert_that(get_traversal_proxy_stats(), has_properties(proxies=0))
+
+    def test_equivalent_switch_skipped(self):
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        host_site = TrivialSite(HSM('example.com', 'siteman', host_comps, pers_comps))
+        new_site = TrivialSite(BaseComponents(BASE, 'sub_site', (pers_comps,)))
+
+        setSite(None)
+        threadSiteSubscriber(host_site, None)
+        threadSiteSubscriber(new_site, None)
+        proxy = getSite()
+        hook = hooks.siteinfo.adapter_hook
+
+        # Traversing the same site again, or the proxy itself, changes nothing.
+        threadSiteSubscriber(new_site, None)
+        threadSiteSubscriber(proxy, None)
+        assert_that(getSite(), is_(same_instance(proxy)))
+        assert_that(hooks.siteinfo.adapter_hook, is_(same_instance(hook)))
+
+        assert_that(get_traversal_proxy_stats(),
+                    has_properties(switches=2, switches_skipped=2, proxies=1))
+
+        set_memoize_traversal_lookups(True)
+        try:
+            threadSiteSubscriber(TrivialSite(BaseComponents(BASE, 'other', (pers_comps,))),
+                                 None)
+            threadSiteSubscriber(new_site, None)
+            memo_proxy = getSite()
+            threadSiteSubscriber(new_site, None)
+            assert_that(getSite(), is_(same_instance(memo_proxy)))
+        finally:
+            set_memoize_traversal_lookups(False)
+        assert_that(get_traversal_proxy_stats(),
+                    has_properties(switches=4, switches_skipped=3))
+        setSite()
+
+        # With the host site installed by a tween, each request
+        # counts its own switches once reset.
+        for _ in range(3):
+            reset_traversal_proxy_stats()
+            setSite(host_site)
+            threadSiteSubscriber(new_site, None)
+            threadSiteSubscriber(new_site, None)
+            assert_that(get_traversal_proxy_stats(),
+                        has_properties(switches=1, switches_skipped=1))
+            setSite()
+
+    def test_ignored_traversal_decisions_cached(self):
+        class Site(object):
+            def __init__(self):
+                self.sm = LSM(None)
+            def getSiteManager(self):
+                return self.sm
+
+        installed = Site()
+        new_site = Site()
+        with fudge.patch('nti.site.subscribers._ignored_traversals', {}) as decisions:
+            setSite(installed)
+            threadSiteSubscriber(new_site, None)
+            assert_that(getSite(), is_(same_instance(new_site)))
+            assert_that(decisions, is_({(providedBy(installed), providedBy(new_site)): False}))
+
+            # Directly providing an interface is a new decision
+            setSite(installed)
+            other = Site()
+            interface.alsoProvides(other, IMainApplicationFolder)
+            threadSiteSubscriber(other, None)
+            assert_that(getSite(), is_(same_instance(installed)))
+            assert_that(decisions, has_length(2))
+
+            with fudge.patch('nti.site.subscribers._MAX_IGNORED_TRAVERSALS', 2):
+                interface.alsoProvides(other, IRootFolder)
+                threadSiteSubscriber(other, None)
+                assert_that(decisions, has_length(1))
+        setSite()
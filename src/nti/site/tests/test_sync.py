@@ -12,14 +12,19 @@ from hamcrest import raises
 from hamcrest import calling
 from hamcrest import has_key
 from hamcrest import contains_exactly as contains
+from hamcrest import none
 from hamcrest import not_none
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_property
 from hamcrest import same_instance
+from hamcrest import greater_than
 does_not = is_not
 
 import unittest
+from unittest import mock
+
+import transaction
 
 from zope import interface
 
@@ -172,13 +177,26 @@ _SITES = (EVAL, EVALALPHA, DEMO, DEMOALPHA)
 from zope.component.interfaces import ISite
 from zope.interface.interfaces import IComponents
 
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
 from zope.site.interfaces import INewLocalSite
 
 from nti.site.interfaces import IHostPolicySiteManager
+from nti.site.interfaces import ITransactionSiteNames
+
+from ZODB.interfaces import IDatabase
 
 from nti.site.hostpolicy import synchronize_host_policies
 from nti.site.hostpolicy import run_job_in_all_host_sites
+from nti.site.hostpolicy import iter_job_in_all_host_sites
 from nti.site.hostpolicy import get_host_site
+from nti.site.hostpolicy import get_host_site_children
+from nti.site.hostpolicy import iter_host_site_subtree
+from nti.site.hostpolicy import materialize_host_site
+from nti.site.hostpolicy import provision_host_sites
+from nti.site.hostpolicy import remove_host_sites
+
+from nti.site.runner import run_job_in_site
 
 from nti.site.site import _find_site_components
 from nti.site.site import get_site_for_site_names
@@ -204,6 +222,8 @@ class TestSiteSync(unittest.TestCase):
     layer = SharedConfiguringTestLayer
 
     _events = ()
+    #: Set by WithMockDS
+    db = None
 
     def setUp(self):
         super().setUp()
@@ -352,6 +372,327 @@ class TestSiteSync(unittest.TestCase):
         # No new sites created
         assert_that(self._events, has_length(len(_SITES)))
 
+    @WithMockDS
+    def test_iter_job_in_all_host_sites(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            names = [EVAL.__name__, DEMO.__name__, EVALALPHA.__name__, DEMOALPHA.__name__]
+            expected = [(sites[name], name) for name in names]
+            # Sites are found through the index, not by loading them all.
+            with mock.patch('nti.site.hostpolicy.get_all_host_sites') as get_all:
+                results = iter_job_in_all_host_sites(lambda: getSite().__name__,
+                                                     cache_gc=True)
+                assert_that(next(results), is_(expected[0]))
+                assert_that(list(results), is_(expected[1:]))
+            assert_that(get_all.call_count, is_(0))
+
+            # Without a complete index, they are all loaded.
+            sites.parentIndex.pop(DEMOALPHA.__name__)
+            results = iter_job_in_all_host_sites(lambda: getSite().__name__)
+            assert_that(sorted(name for _, name in results), is_(sorted(names)))
+
+    @WithMockDS
+    def test_iter_job_in_all_host_sites_commits(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        conn = self.db.open()
+        try:
+            commits = []
+            transaction.get().addAfterCommitHook(commits.append)
+            with currentSite(conn.root()['nti.dataserver']):
+                def func():
+                    getSite().touched = True
+                    return len(commits)
+
+                results = [r for _, r in iter_job_in_all_host_sites(func, commit_every=3)]
+            # We committed after the third site, and the remainder is
+            # left for us.
+            assert_that(results, is_([0, 0, 0, 1]))
+            transaction.commit()
+        finally:
+            conn.close()
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            for site in _SITES:
+                assert_that(sites[site.__name__], has_property('touched', True))
+
+    @WithMockDS
+    def test_children_index(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites.getChildSiteNames(), is_((EVAL.__name__,)))
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMO.__name__, EVALALPHA.__name__)))
+            assert_that(get_host_site_children(DEMO.__name__),
+                        is_([sites[DEMOALPHA.__name__]]))
+
+            assert_that([s.__name__ for s in iter_host_site_subtree(EVAL.__name__)],
+                        is_([EVAL.__name__, DEMO.__name__, EVALALPHA.__name__,
+                             DEMOALPHA.__name__]))
+
+            names = []
+            run_job_in_all_host_sites(lambda: names.append(getSite().__name__),
+                                      root_site=sites[DEMO.__name__])
+            assert_that(names, is_([DEMO.__name__, DEMOALPHA.__name__]))
+
+            # Sites created before the index existed are still found,
+            # without writing the index...
+            def _index():
+                return {k: tuple(v) for k, v in sites.childrenIndex.items()}
+            index = _index()
+            sites.childrenIndex = sites.parentIndex = None
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMO.__name__, EVALALPHA.__name__)))
+            assert_that(sites.childrenIndex, is_(none()))
+            # ...which synchronizing builds.
+            synchronize_host_policies()
+            assert_that(_index(), is_(index))
+
+            # Removing a site unindexes it.
+            del sites[DEMOALPHA.__name__]
+            assert_that(sites.getChildSiteNames(DEMO.__name__), is_(()))
+            sites.unindexHostSite(DEMOALPHA.__name__)
+
+    @WithMockDS
+    def test_children_index_removed_parent(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+
+            # The children of a removed site are still reached from the top.
+            del sites[DEMO.__name__]
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMOALPHA.__name__, EVALALPHA.__name__)))
+            names = [name for _, name in
+                     iter_job_in_all_host_sites(lambda: getSite().__name__)]
+            assert_that(names, is_([EVAL.__name__, DEMOALPHA.__name__, EVALALPHA.__name__]))
+
+            # Recreating the site puts them back.
+            synchronize_host_policies()
+            assert_that(sites.getChildSiteNames(DEMO.__name__), is_((DEMOALPHA.__name__,)))
+
+            # An index that doesn't reach every site isn't trusted.
+            sites.childrenIndex[EVAL.__name__].remove(DEMO.__name__)
+            names = [name for _, name in
+                     iter_job_in_all_host_sites(lambda: getSite().__name__)]
+            assert_that(sorted(names), is_(sorted(site.__name__ for site in _SITES)))
+
+    @WithMockDS
+    def test_remove_host_sites(self):
+        gsm = component.getGlobalSiteManager()
+        with mock_db_trans() as conn:
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            # The components are still registered when the removal
+            # event is handled.
+            registered_when_removed = []
+            @component.adapter(IHostPolicyFolder, IObjectRemovedEvent)
+            def on_removed(site, _event):
+                registered_when_removed.append(
+                    gsm.queryUtility(IComponents, site.__name__) is not None)
+            gsm.registerHandler(on_removed)
+            generation = gsm.utilities._generation
+            try:
+                removed = remove_host_sites((DEMO.__name__, DEMOALPHA.__name__, 'missing'),
+                                            registry=gsm)
+            finally:
+                gsm.unregisterHandler(on_removed)
+            # The global registry is invalidated once, not once for
+            # each registration and subscription of each site.
+            assert_that(gsm.utilities._generation, is_(generation + 1))
+            # Children first
+            assert_that(removed, is_([DEMOALPHA.__name__, DEMO.__name__]))
+            assert_that(registered_when_removed, is_([True, True]))
+            assert_that(gsm.queryUtility(IComponents, DEMO.__name__), is_(none()))
+            assert_that(gsm.queryUtility(IComponents, DEMOALPHA.__name__), is_(none()))
+            assert_that(gsm.queryUtility(IComponents, EVAL.__name__), is_(EVAL))
+            assert_that(sorted(sites), is_(sorted([EVAL.__name__, EVALALPHA.__name__])))
+            assert_that(sites.getChildSiteNames(EVAL.__name__), is_((EVALALPHA.__name__,)))
+
+            # By default, only the current site manager is changed.
+            assert_that(remove_host_sites((EVALALPHA.__name__,)),
+                        is_([EVALALPHA.__name__]))
+            assert_that(gsm.queryUtility(IComponents, EVALALPHA.__name__), is_(EVALALPHA))
+
+    @WithMockDS
+    def test_remove_host_sites_coalesces_persistent_changes(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            site_manager = component.getSiteManager()
+            for comps in DEMO, DEMOALPHA:
+                site_manager.registerUtility(comps, IComponents, name=comps.__name__)
+            utilities = site_manager.utilities
+            generation = utilities._generation
+
+            remove_host_sites((DEMO.__name__, DEMOALPHA.__name__))
+            # Both unregistered by the removal events, with one invalidation
+            # instead of four (one for each registration and its subscription).
+            assert_that(utilities._generation, is_(generation + 1))
+            assert_that([reg for reg in site_manager.registeredUtilities()
+                         if reg.provided is IComponents],
+                        has_length(0))
+            assert_that(sorted(sites), is_(sorted([EVAL.__name__, EVALALPHA.__name__])))
+
+            # Changes aren't deferred afterwards.
+            site_manager.registerUtility(DEMO, IComponents, name=DEMO.__name__)
+            assert_that(utilities._generation, is_(generation + 3))
+
+    @WithMockDS
+    def test_lazy_sites(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies(lazy=True)
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites, has_length(0))
+            assert_that(sites.materializedSiteCount, is_(0))
+
+        with mock_db_trans() as conn:
+            # Stays lazy
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites, has_length(0))
+
+            # Resolving does not create anything; the site is not
+            # persistent.
+            site = get_site_for_site_names((DEMOALPHA.__name__,))
+            assert_that(IHostPolicyFolder.providedBy(site), is_(False))
+            assert_that(site.__name__, is_(DEMOALPHA.__name__))
+            assert_that(site.getSiteManager().queryUtility(ITestSiteSync), is_(ASync))
+            assert_that(sites, has_length(0))
+            assert_that(self._events, has_length(0))
+
+            # Materializing creates the site and its ancestors
+            site = materialize_host_site(DEMOALPHA)
+            assert_that(site, is_(same_instance(sites[DEMOALPHA.__name__])))
+            assert_that(get_site_for_site_names((DEMOALPHA.__name__,)),
+                        is_(same_instance(site)))
+            assert_that(sorted(sites), is_(sorted([EVAL.__name__, DEMO.__name__,
+                                                   DEMOALPHA.__name__])))
+            assert_that(sites.materializedSiteCount, is_(3))
+            assert_that(site.getSiteManager().queryUtility(ITestSiteSync), is_(ASync))
+            assert_that(self._events, has_length(3))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(get_site_for_site_names((DEMO.__name__,)),
+                        is_(same_instance(sites[DEMO.__name__])))
+            assert_that(materialize_host_site(EVALALPHA),
+                        is_(same_instance(sites[EVALALPHA.__name__])))
+            assert_that(sites.materializedSiteCount, is_(4))
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMO.__name__, EVALALPHA.__name__)))
+
+            # Turning lazy mode off creates everything else.
+            synchronize_host_policies(lazy=False)
+            assert_that(sites, has_length(len(_SITES)))
+
+    @WithMockDS
+    def test_lazy_sites_created_by_writable_jobs(self):
+        with mock_db_trans():
+            synchronize_host_policies(lazy=True)
+
+        def site_names(*_args, **_kwargs):
+            return (DEMOALPHA.__name__,)
+        def func():
+            site = getSite()
+            # pylint:disable-next=no-value-for-parameter
+            return IHostPolicyFolder.providedBy(site), site.__name__
+
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(self.db, IDatabase)
+        gsm.registerUtility(site_names, ITransactionSiteNames)
+        try:
+            # Jobs that can't write don't create the site...
+            assert_that(run_job_in_site(func, read_only=True),
+                        is_((False, DEMOALPHA.__name__)))
+            assert_that(run_job_in_site(func, side_effect_free=True),
+                        is_((False, DEMOALPHA.__name__)))
+            with mock_db_trans() as conn:
+                sites = conn.root()['nti.dataserver']['++etc++hostsites']
+                assert_that(sites, has_length(0))
+
+            # ...but other jobs do, along with its ancestors.
+            assert_that(run_job_in_site(func), is_((True, DEMOALPHA.__name__)))
+            assert_that(run_job_in_site(func), is_((True, DEMOALPHA.__name__)))
+        finally:
+            gsm.unregisterUtility(self.db, IDatabase)
+            gsm.unregisterUtility(site_names, ITransactionSiteNames)
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sorted(sites), is_(sorted([EVAL.__name__, DEMO.__name__,
+                                                   DEMOALPHA.__name__])))
+            assert_that(sites.materializedSiteCount, is_(3))
+
+    @WithMockDS
+    def test_provision_host_sites(self):
+        conn = self.db.open()
+        try:
+            with currentSite(conn.root()['nti.dataserver']):
+                result = provision_host_sites(batch_size=3,
+                                              site_names=(DEMOALPHA.__name__,))
+                assert_that(result, has_property('created', 3))
+                assert_that(result, has_property('batches', 1))
+                repr(result)
+
+                # Parents are created first, in earlier batches.
+                result = provision_host_sites(batch_size=1)
+                assert_that(result, has_property('created', 1))
+                assert_that(result, has_property('batches', 1))
+                assert_that(result.sites_per_second, is_(greater_than(0)))
+
+                result = provision_host_sites()
+                assert_that(result, has_property('created', 0))
+                assert_that(result.sites_per_second, is_(0.0))
+            transaction.abort()
+        finally:
+            conn.close()
+
+        # Everything was committed.
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites, has_length(len(_SITES)))
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMO.__name__, EVALALPHA.__name__)))
+        assert_that(self._events, has_length(len(_SITES)))
+
+    @WithMockDS
+    def test_provision_host_sites_in_small_batches(self):
+        conn = self.db.open()
+        commits = []
+        # Synchronizers are weakly referenced.
+        synch = mock.Mock(afterCompletion=commits.append)
+        try:
+            conn.transaction_manager.registerSynch(synch)
+            with currentSite(conn.root()['nti.dataserver']):
+                result = provision_host_sites(batch_size=1)
+            names = [event[0].__parent__.__name__ for event in self._events]
+            transaction.abort()
+        finally:
+            conn.close()
+
+        assert_that(result, has_property('created', len(_SITES)))
+        assert_that(result, has_property('batches', len(_SITES)))
+        # One commit per batch, and then our abort.
+        assert_that(commits, has_length(len(_SITES) + 1))
+        # Parents were created before their children.
+        assert_that(names, has_length(len(_SITES)))
+        assert_that(names.index(EVAL.__name__), is_(0))
+        assert_that(names.index(DEMO.__name__),
+                    is_(greater_than(names.index(EVAL.__name__))))
+        assert_that(names.index(DEMOALPHA.__name__),
+                    is_(greater_than(names.index(DEMO.__name__))))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites, has_length(len(_SITES)))
+
     @WithMockDS
     def test_site_mapping(self):
         """
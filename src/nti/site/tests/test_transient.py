@@ -13,6 +13,8 @@ from hamcrest import raises
 from hamcrest import calling
 from hamcrest import assert_that
 from hamcrest import has_property
+from hamcrest import none
+from hamcrest import not_none
 does_not = is_not
 
 import unittest
@@ -21,11 +23,39 @@ import pickle
 
 from zope.component import globalSiteManager as BASE
 
+from zope.interface import Interface
+from zope.interface.interfaces import ComponentLookupError
+
 from z3c.baseregistry.baseregistry import BaseComponents
 
 from nti.site.transient import HostSiteManager as HSM
+from nti.site.transient import HostLookupSiteManager
+from nti.site.transient import LookupSiteManager
 from nti.site.transient import TrivialSite
 
+class IFoo(Interface): # pylint:disable=inherit-non-class
+    pass
+
+
+def _check_not_subregistry(test, factory):
+    pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+    host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+    registries = [comps.adapters for comps in (pers_comps, host_comps)]
+    registries += [comps.utilities for comps in (pers_comps, host_comps)]
+
+    managers = [factory(host_comps, pers_comps) for _ in range(5)]
+    test.assertEqual([len(reg._v_subregistries) for reg in registries],
+                     [0, 0, 0, 0])
+
+    # Changes to the bases are still seen.
+    for sm in managers:
+        assert_that(sm.queryUtility(IFoo), is_(none()))
+    util = object()
+    pers_comps.registerUtility(util, IFoo)
+    for sm in managers:
+        assert_that(sm.queryUtility(IFoo), is_(util))
+
+
 class TestHSM(unittest.TestCase):
 
     def _makeOne(self):
@@ -46,12 +76,87 @@ class TestHSM(unittest.TestCase):
         assert_that(calling(pickle.dumps).with_args(host_sm),
                     raises(TypeError, "BasedSiteManager should not be pickled"))
 
+    def test_not_subregistry_of_bases(self):
+        _check_not_subregistry(
+            self,
+            lambda host, pers: HSM('example.com', 'siteman', host, pers))
+
     def test_not_folderish(self):
         host_sm = self._makeOne()[0]
         assert_that(calling(host_sm.__setitem__).with_args('key', object()),
                     raises(AttributeError))
 
 
+class TestLookupSiteManager(unittest.TestCase):
+
+    def _makeOne(self):
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, 'example.com', (BASE,))
+        host_sm = HostLookupSiteManager('example.com', 'siteman', host_comps, pers_comps)
+        return host_sm, pers_comps, host_comps
+
+    def test_cover(self):
+        host_sm, pers_comps, host_comps = self._makeOne()
+
+        assert_that(host_sm, has_property('host_components', is_(host_comps)))
+        assert_that(host_sm, has_property('persistent_components', is_(pers_comps)))
+        assert_that(host_sm, has_property('__bases__', (host_comps, pers_comps)))
+        assert_that(host_sm, has_property('__name__', 'siteman'))
+        assert_that(list(host_sm.registeredUtilities()), is_([]))
+
+    def test_no_host_components_by_default(self):
+        sm = LookupSiteManager(None, 'sm', (BASE,))
+        assert_that(hasattr(sm, 'host_components'), is_(False))
+        assert_that(calling(setattr).with_args(sm, 'other', 1),
+                    raises(AttributeError))
+
+    def test_lookup(self):
+        host_sm, pers_comps, host_comps = self._makeOne()
+        util = object()
+        pers_comps.registerUtility(util, IFoo)
+        assert_that(host_sm.getUtility(IFoo), is_(util))
+
+        host_util = object()
+        host_comps.registerUtility(host_util, IFoo)
+        assert_that(host_sm.getUtility(IFoo), is_(host_util))
+        assert_that(host_sm.queryUtility(IFoo, 'missing'), is_(none()))
+        assert_that(calling(host_sm.getUtility).with_args(IFoo, 'missing'),
+                    raises(ComponentLookupError))
+
+    def test_not_subregistry_of_bases(self):
+        _check_not_subregistry(
+            self,
+            lambda host, pers: HostLookupSiteManager('example.com', 'siteman', host, pers))
+
+    def test_local_registrations(self):
+        host_sm, pers_comps, host_comps = self._makeOne()
+        pers_comps.registerUtility(object(), IFoo)
+        assert_that(host_sm.local_components, is_(none()))
+        # Nothing to unregister
+        assert_that(host_sm.unregisterAdapter(object), is_(False))
+        assert_that(host_sm.unregisterUtility(object(), IFoo), is_(False))
+
+        util = object()
+        host_sm.registerUtility(util, IFoo)
+        assert_that(host_sm.local_components, is_(not_none()))
+        # It comes before the bases...
+        assert_that(host_sm.getUtility(IFoo), is_(util))
+        assert_that(host_sm, has_property('__bases__', (host_comps, pers_comps)))
+        assert_that([reg.component for reg in host_sm.registeredUtilities()],
+                    is_([util]))
+        # ... and survives changing them.
+        host_sm.__bases__ = (host_comps,)
+        assert_that(host_sm.getUtility(IFoo), is_(util))
+
+        assert_that(host_sm.unregisterUtility(util, IFoo), is_(True))
+        assert_that(host_sm.queryUtility(IFoo), is_(none()))
+
+    def test_pickle(self):
+        host_sm = self._makeOne()[0]
+        assert_that(calling(pickle.dumps).with_args(host_sm),
+                    raises(TypeError, "LookupSiteManager should not be pickled"))
+
+
 class TestTrivialSite(unittest.TestCase):
 
     def _makeOne(self):
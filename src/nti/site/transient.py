@@ -19,6 +19,12 @@ logger = __import__('logging').getLogger(__name__)
 
 from zope import interface
 
+from zope.interface import providedBy
+from zope.interface.adapter import VerifyingAdapterRegistry
+from zope.interface.interfaces import ComponentLookupError
+from zope.interface.interfaces import IComponentLookup
+from zope.interface.registry import Components
+
 from zope.component import interfaces as comp_interfaces
 from zope.component.persistentregistry import PersistentComponents as _ZPersistentComponents
 
@@ -34,23 +40,21 @@ class BasedSiteManager(_ZLocalSiteManager):
     A site manager that exists simply to have bases, but not to
     record itself as children of those bases (since that's unnecessary
     for our purposes and leads to ZODB conflicts).
+
+    .. versionchanged:: 3.2.0
+       Use non-persistent verifying adapter registries that are never
+       tracked by the base registries.
     """
 
-    # Note that the adapter registries in the base objects /will/ have
-    # weak references to this object; it's very hard to stop this. These
-    # will stick around until a gc is run. (For testing purposes,
-    # it is important to GC or you can get weird errors like:
-    # File "zope/interface/adapter.py", line 456, in changed
-    #   super(AdapterLookupBase, self).changed(None)
-    # File "ZODB/Connection.py", line 857, in setstate
-    #   raise ConnectionStateError(msg)
-    #  ConfigurationExecutionError: <class 'ZODB.POSException.ConnectionStateError'>:
-    #   Shouldn't load state for 0x237f4ee301650a49 when the connection is closed
-    # in:
-    # File "zope/site/configure.zcml", line 13.4-14.71
-    # <implements interface="zope.annotation.interfaces.IAttributeAnnotatable" />
-    # Fortunately, CPython's GC is precise and refcounting, so as long as we do not leak
-    # refs to these, we're fine
+    # Our adapter registries are :class:`VerifyingAdapterRegistry`
+    # objects: instead of being told about changes by their bases (push
+    # invalidation), they check the generation of each base before
+    # trusting their cache. Therefore they never add themselves to the
+    # ``_v_subregistries`` of the base registries, so those don't grow
+    # with the number of transient site managers created (for example,
+    # one per request), and calling ``changed()`` on a base doesn't
+    # have to visit them. (Previously, the base registries could hold
+    # weak references to these objects until a gc was run.)
 
     def _setBases(self, bases):
         # Bypass the direct superclass.
@@ -67,6 +71,12 @@ class BasedSiteManager(_ZLocalSiteManager):
         self.__name__ = name
         self.__bases__ = bases
 
+    def _init_registries(self):
+        # Bypass the direct superclass, which uses persistent
+        # registries.
+        self.adapters = VerifyingAdapterRegistry()
+        self.utilities = VerifyingAdapterRegistry()
+
     def _newContainerData(self):  # pragma: no cover
         return None  # We won't be used as a folder
 
@@ -98,6 +108,267 @@ class HostSiteManager(BasedSiteManager): # pylint:disable=too-many-ancestors
     def persistent_components(self):
         return self._persistent_components
 
+class _LookupAdapterRegistry(VerifyingAdapterRegistry):
+    # The lookup methods are copied onto each instance from its
+    # lookup object (see ``BaseAdapterRegistry._delegated``), which
+    # static analysis can't see. Declare the ones we use; the instance
+    # attributes take precedence.
+
+    def lookup(self, required, provided, name='', default=None):
+        return self._v_lookup.lookup(required, provided, name, default)
+
+    def lookupAll(self, required, provided):
+        return self._v_lookup.lookupAll(required, provided)
+
+    def subscriptions(self, required, provided):
+        return self._v_lookup.subscriptions(required, provided)
+
+    def queryAdapter(self, object, provided, name='', default=None): # pylint:disable=redefined-builtin
+        return self._v_lookup.queryAdapter(object, provided, name, default)
+
+    def queryMultiAdapter(self, objects, provided, name='', default=None):
+        return self._v_lookup.queryMultiAdapter(objects, provided, name, default)
+
+    def subscribers(self, objects, provided):
+        return self._v_lookup.subscribers(objects, provided)
+
+
+def _registering(name):
+    def register(self, *args, **kwargs):
+        return getattr(self._getLocalComponents(), name)(*args, **kwargs)
+    register.__name__ = name
+    return register
+
+
+def _unregistering(name):
+    def unregister(self, *args, **kwargs):
+        if self._local_components is None:
+            return False
+        return getattr(self._local_components, name)(*args, **kwargs)
+    unregister.__name__ = name
+    return unregister
+
+
+def _listing_registrations(name):
+    def registered(self):
+        if self._local_components is None:
+            return iter(())
+        return getattr(self._local_components, name)()
+    registered.__name__ = name
+    return registered
+
+
+@interface.implementer(IComponentLookup)
+class LookupSiteManager(object):
+    """
+    A minimal, non-persistent site manager that exists mostly to look
+    things up in its bases.
+
+    Unlike :class:`BasedSiteManager`, this usually holds nothing but
+    its bases and the two adapter registries (and their lookup caches)
+    needed to search them. It uses ``__slots__``, so it's cheap to
+    create.
+
+    Registrations made through it are kept in a registry of its own,
+    created the first time something is registered, that is searched
+    before the bases; see :attr:`local_components`. Unregistering
+    something that wasn't registered through this object does nothing
+    and returns False, just like it does for any other site manager.
+
+    The adapter registries verify the generations of the registries in
+    their bases before using cached data, so they don't need to be
+    notified of changes by (and hence don't register themselves with)
+    the base registries.
+
+    .. versionadded:: 3.2.0
+    """
+
+    __slots__ = (
+        '__parent__',
+        '__name__',
+        '_bases',
+        '_local_components',
+        'adapters',
+        'utilities',
+        # Set by nti.site.subscribers.threadSiteSubscriber
+        'host_components',
+    )
+
+    def __init__(self, site, name, bases):
+        self.__parent__ = site
+        self.__name__ = name
+        self.adapters = _LookupAdapterRegistry()
+        self.utilities = _LookupAdapterRegistry()
+        self._local_components = None
+        self._bases = ()
+        self.__bases__ = bases
+
+    def _setBases(self, bases):
+        bases = tuple(bases)
+        searched = bases
+        if self._local_components is not None:
+            searched = (self._local_components,) + bases
+        self.adapters.__bases__ = tuple(base.adapters for base in searched)
+        self.utilities.__bases__ = tuple(base.utilities for base in searched)
+        self._bases = bases
+
+    __bases__ = property(lambda self: self._bases,
+                         _setBases)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.__name__)
+
+    def __reduce__(self):
+        raise TypeError("LookupSiteManager should not be pickled")
+
+    @property
+    def local_components(self):
+        """
+        The :class:`~zope.interface.registry.Components` holding what
+        has been registered through this object, or None if nothing
+        has been.
+        """
+        return self._local_components
+
+    def _getLocalComponents(self):
+        if self._local_components is None:
+            self._local_components = Components(self.__name__)
+            self.__bases__ = self._bases
+        return self._local_components
+
+    # Lookup. These match zope.interface.registry.Components.
+
+    def queryUtility(self, provided, name='', default=None):
+        return self.utilities.lookup((), provided, name, default)
+
+    def getUtility(self, provided, name=''):
+        utility = self.utilities.lookup((), provided, name)
+        if utility is None:
+            raise ComponentLookupError(provided, name)
+        return utility
+
+    def getUtilitiesFor(self, provided):
+        return iter(self.utilities.lookupAll((), provided))
+
+    def getAllUtilitiesRegisteredFor(self, provided):
+        return self.utilities.subscriptions((), provided)
+
+    def queryAdapter(self, object, provided, name='', default=None): # pylint:disable=redefined-builtin
+        return self.adapters.queryAdapter(object, provided, name, default)
+
+    def getAdapter(self, object, provided, name=''): # pylint:disable=redefined-builtin
+        adapter = self.adapters.queryAdapter(object, provided, name)
+        if adapter is None:
+            raise ComponentLookupError(object, provided, name)
+        return adapter
+
+    def queryMultiAdapter(self, objects, provided, name='', default=None):
+        return self.adapters.queryMultiAdapter(objects, provided, name, default)
+
+    def getMultiAdapter(self, objects, provided, name=''):
+        adapter = self.adapters.queryMultiAdapter(objects, provided, name)
+        if adapter is None:
+            raise ComponentLookupError(objects, provided, name)
+        return adapter
+
+    def getAdapters(self, objects, provided):
+        for name, factory in self.adapters.lookupAll([providedBy(o) for o in objects],
+                                                     provided):
+            adapter = factory(*objects)
+            if adapter is not None:
+                yield name, adapter
+
+    def subscribers(self, objects, provided):
+        return self.adapters.subscribers(objects, provided)
+
+    def handle(self, *objects):
+        self.adapters.subscribers(objects, None)
+
+    # Registration. These go to the local components.
+
+    registerUtility = _registering('registerUtility')
+    registerAdapter = _registering('registerAdapter')
+    registerSubscriptionAdapter = _registering('registerSubscriptionAdapter')
+    registerHandler = _registering('registerHandler')
+
+    unregisterUtility = _unregistering('unregisterUtility')
+    unregisterAdapter = _unregistering('unregisterAdapter')
+    unregisterSubscriptionAdapter = _unregistering('unregisterSubscriptionAdapter')
+    unregisterHandler = _unregistering('unregisterHandler')
+
+    registeredUtilities = _listing_registrations('registeredUtilities')
+    registeredAdapters = _listing_registrations('registeredAdapters')
+    registeredSubscriptionAdapters = _listing_registrations('registeredSubscriptionAdapters')
+    registeredHandlers = _listing_registrations('registeredHandlers')
+
+
+class HostLookupSiteManager(LookupSiteManager):
+    """
+    A :class:`LookupSiteManager` for globally registered IComponents
+    plus the application persistent components, like :class:`HostSiteManager`.
+
+    .. versionadded:: 3.2.0
+    """
+
+    __slots__ = (
+        'persistent_components',
+    )
+
+    def __init__(self, site, name, host_components, persistent_components):
+        self.host_components = host_components
+        self.persistent_components = persistent_components
+        LookupSiteManager.__init__(self, site, name,
+                                   (host_components, persistent_components))
+
+
+_MISSING = object()
+
+class MemoizingSiteManager(object):
+    """
+    Wraps a site manager, remembering the results of utility lookups
+    by ``(provided, name)``. Everything else is delegated to the
+    wrapped site manager.
+
+    This is meant to live only as long as the site it is installed
+    with (typically, one request); it doesn't notice registrations
+    made while it is in use. Adapter lookups aren't memoized because
+    their results depend on the objects being adapted.
+
+    .. versionadded:: 3.2.0
+    """
+
+    __slots__ = (
+        '_site_manager',
+        '_utilities',
+    )
+
+    def __init__(self, site_manager):
+        self._site_manager = site_manager
+        self._utilities = {}
+
+    def __getattr__(self, name):
+        return getattr(self._site_manager, name)
+
+    def queryUtility(self, provided, name='', default=None):
+        key = (provided, name)
+        utility = self._utilities.get(key, _MISSING)
+        if utility is _MISSING:
+            utility = self._utilities[key] = self._site_manager.queryUtility(provided, name)
+        return default if utility is None else utility
+
+    def getUtility(self, provided, name=''):
+        utility = self.queryUtility(provided, name)
+        if utility is None:
+            raise ComponentLookupError(provided, name)
+        return utility
+
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, self._site_manager)
+
+    def __reduce__(self):
+        raise TypeError("MemoizingSiteManager should not be pickled")
+
+
 @interface.implementer(comp_interfaces.ISite)
 class TrivialSite(_ZContained):
     """